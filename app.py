@@ -1,108 +1,830 @@
 import streamlit as st
-import openai
 import io
-import base64
-from PIL import Image
+import hashlib
+import inspect
+import re
+import contextvars
 import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-import fitz  # PyMuPDF
+# PyMuPDF (fitz) and PIL are imported by the functions that use them, so the
+# page renders without loading them until a PDF is uploaded
+
+import limits
+import tracing
+from cache import make_cache_key, shared_cache
+from code_merge import merge_story_modules, strip_code_fences
+from code_patch import PatchError, apply_patch, parse_patch, validate_code
+from jobs import get_job_manager
+from manifest import load_manifest, plan_revision, save_manifest, story_key
+from prompts import get_prompt, prompt_token_counts
+from story_context import build_story_context, estimate_tokens
+from validation import ValidationError, validate_python, validate_schema
+
+# Load environment variables (before providers reads its settings)
+load_dotenv()
 
-# import google.generativeai as genai
-from google import genai
+from providers import LLM_BACKEND, LLM_FIXTURES_DIR, LLM_RECORD_MODE, get_provider
+
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+VISION_MODEL = "gpt-4o"
+BOILERPLATE_MODEL = "gpt-4o"
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "4"))
+# GPT-4o fits high-detail images into 2048x2048 and then scales the short side to 768,
+# so anything larger is uploaded for nothing
+VISION_MAX_LONG_SIDE = int(os.getenv("VISION_MAX_LONG_SIDE", "2048"))
+VISION_MAX_SHORT_SIDE = int(os.getenv("VISION_MAX_SHORT_SIDE", "768"))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG")  # JPEG or WEBP
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+# Formats the vision API accepts as-is
+ACCEPTED_IMAGE_EXTS = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+# Candidate DPIs for page rendering, cheapest first
+RENDER_DPIS = (72, 96, 120, 150, 200)
+# Smallest text height (in pixels, after the API's own downscaling) we still consider readable
+MIN_READABLE_TEXT_PX = int(os.getenv("MIN_READABLE_TEXT_PX", "10"))
+# Hybrid mode: the text layer carries the labels, so a smaller image is enough for layout
+HYBRID_MAX_LONG_SIDE = int(os.getenv("HYBRID_MAX_LONG_SIDE", "1024"))
+HYBRID_MAX_SHORT_SIDE = int(os.getenv("HYBRID_MAX_SHORT_SIDE", "512"))
+# Pages with at least this much text and little visual content are sent as text only
+TEXT_DOMINANT_MIN_CHARS = int(os.getenv("TEXT_DOMINANT_MIN_CHARS", "200"))
+TEXT_DOMINANT_MAX_VISUAL_RATIO = float(os.getenv("TEXT_DOMINANT_MAX_VISUAL_RATIO", "0.15"))
+VISION_MODES = ["Image only", "Hybrid (text + image)"]
+VISION_MAX_OUTPUT_TOKENS = 1000
+# Screenshots packed into one vision request (1 sends each image on its own)
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "1"))
+# Estimated input tokens (images plus text layers) allowed in one batched request
+VISION_BATCH_TOKEN_BUDGET = int(os.getenv("VISION_BATCH_TOKEN_BUDGET", "6000"))
+# Images smaller than this on either side are treated as icons/bullets and skipped
+MIN_IMAGE_SIDE = int(os.getenv("MIN_IMAGE_SIDE", "48"))
+
+# Repeat screenshots return their user story from disk instead of calling GPT-4o again.
+# Shared by every session in the process, so one user's result serves the others.
+vision_cache = shared_cache(
+    os.path.join(CACHE_DIR, "vision"),
+    max_bytes=int(os.getenv("VISION_CACHE_MAX_MB", "50")) * 1024 * 1024,
+)
+
+SCHEMA_MODEL = "gemini-2.0-flash"
+CODE_MODEL = "gemini-2.0-flash"
+CODEGEN_MODES = ["Serial chain", "Serial diff patches", "Parallel per-story"]
+CODEGEN_CONCURRENCY = int(os.getenv("CODEGEN_CONCURRENCY", "4"))
+# Resumes only send the end of the unfinished code, not the whole history
+CONTINUATION_TAIL_CHARS = int(os.getenv("CONTINUATION_TAIL_CHARS", "4000"))
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "5"))
+# Extra attempts for a single step whose output fails local validation
+VALIDATION_RETRIES = int(os.getenv("VALIDATION_RETRIES", "2"))
+# Changes whenever the schema prompts change, so old chains are not reused
+SCHEMA_PROMPT_VERSION = f"{get_prompt('schema_system').version}-{get_prompt('schema').version}"
+
+# Each step of the schema chain, keyed by the hash of every story up to and including it
+schema_cache = shared_cache(
+    os.path.join(CACHE_DIR, "schema"),
+    max_bytes=int(os.getenv("SCHEMA_CACHE_MAX_MB", "20")) * 1024 * 1024,
+)
+
+EXTRACTION_MODES = ["Auto", "Embedded images", "Render pages"]
+PROGRAMMING_LANGUAGES = ["Python", "JavaScript", "Java", "C#", "Go", "Typescript"]
+DATABASES = ["PostgreSQL", "MySQL", "SQLite", "Microsoft SQL Server", "JSON"]
+ORMS = ["SQLAlchemy", "Sequelize", "Prisma"]
+# How often a page showing a running background job refreshes
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.5"))
+# Header naming the user, set by an authenticating reverse proxy that strips it from
+# client requests. Off by default: each browser session is then its own user
+USER_HEADER = os.getenv("USER_HEADER", "")
+# ?admin=<token> opens the admin view; it is disabled while no token is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+@dataclass
+class ExtractedImage:
+    """A unique image from the PDF along with every page it appears on."""
+
+    data: bytes  # Raw bytes as stored in the PDF
+    ext: str
+    xref: int
+    digest: str
+    width: int
+    height: int
+    pages: list = field(default_factory=list)  # 1-based page numbers
+    text_spans: list = field(default_factory=list)  # Text layer spans with bounding boxes
+    text_only: bool = False  # Text-dominant page, analysed without any image
+
+    @property
+    def image(self):
+        """Decodes the raw bytes into a PIL Image on demand (not kept in memory)."""
+        from PIL import Image
+
+        return Image.open(io.BytesIO(self.data))
+
+
+def extract_text_spans(page, clip=None):
+    """Returns the page's text layer as spans with bounding boxes in PDF points."""
+    spans = []
+    for block in page.get_text("dict", clip=clip)["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                text = span["text"].strip()
+                if text:
+                    spans.append(
+                        {"text": text, "bbox": [round(v) for v in span["bbox"]]}
+                    )
+    return spans
+
+
+def is_text_dominant(
+    page,
+    min_chars=TEXT_DOMINANT_MIN_CHARS,
+    max_visual_ratio=TEXT_DOMINANT_MAX_VISUAL_RATIO,
+):
+    """True when a page is mostly text, so its text layer can replace the image entirely."""
+    import fitz
+
+    if len(page.get_text().strip()) < min_chars:
+        return False
+    visual_area = sum(
+        abs(drawing["rect"]) for drawing in page.get_drawings() if drawing.get("fill")
+    )
+    visual_area += sum(abs(fitz.Rect(info["bbox"])) for info in page.get_image_info())
+    return visual_area / abs(page.rect) <= max_visual_ratio
+
+
+def estimate_image_tokens(width, height):
+    """Estimates GPT-4o high-detail input tokens for an image (85 base + 170 per 512px tile)."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+
+def perceptual_hash(image, hash_size=8):
+    """Computes a difference hash (dHash) so near-identical images compare equal."""
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def iter_pdf_images(
+    pdf_file, min_side=MIN_IMAGE_SIDE, perceptual=False, max_distance=4, with_text=False
+):
+    """Lazily yields unique ExtractedImage objects from a PDF, page by page.
 
-# Load environment variables
-load_dotenv()
+    Duplicates found on later pages are appended to the ``pages`` of the item
+    that was already yielded, so provenance is complete once the generator is exhausted.
+    """
+    import fitz
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
+    with tracing.span("pdf.open", bytes=len(pdf_file)) as open_span:
+        doc = fitz.open(stream=pdf_file, filetype="pdf")
+        open_span.set(pages=doc.page_count)
 
+    by_xref = {}
+    by_digest = {}
+    by_phash = []  # (hash, ExtractedImage) pairs, compared by hamming distance
+    skipped_xrefs = set()
+    unique_count = 0
 
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    try:
+        for page_num, page in enumerate(doc):
+            for img_index, img in enumerate(page.get_images(full=True)):
+                xref = img[0]  # Image reference
+
+                if xref in skipped_xrefs:
+                    continue
+
+                # Same xref on another page: no need to extract it again
+                if xref in by_xref:
+                    if page_num + 1 not in by_xref[xref].pages:
+                        by_xref[xref].pages.append(page_num + 1)
+                    continue
+
+                with tracing.span("pdf.extract_image", page=page_num + 1, xref=xref):
+                    base_image = doc.extract_image(xref)
+                image_bytes = base_image["image"]
+                width, height = base_image["width"], base_image["height"]
+
+                if min(width, height) < min_side:
+                    skipped_xrefs.add(xref)
+                    continue
+
+                # Same bytes stored under a different xref
+                digest = hashlib.sha256(image_bytes).hexdigest()
+                if digest in by_digest:
+                    by_xref[xref] = by_digest[digest]
+                    if page_num + 1 not in by_digest[digest].pages:
+                        by_digest[digest].pages.append(page_num + 1)
+                    continue
+
+                item = ExtractedImage(
+                    image_bytes, base_image["ext"], xref, digest, width, height, [page_num + 1]
+                )
+                if with_text:
+                    # Only text drawn over the image belongs to it
+                    for rect in page.get_image_rects(xref):
+                        item.text_spans += extract_text_spans(page, clip=rect)
+
+                # Only decode when near-duplicate matching is asked for
+                if perceptual:
+                    phash = perceptual_hash(item.image)
+                    match = next(
+                        (
+                            other_item
+                            for other, other_item in by_phash
+                            if bin(other ^ phash).count("1") <= max_distance
+                        ),
+                        None,
+                    )
+                    if match is not None:
+                        by_xref[xref] = by_digest[digest] = match
+                        if page_num + 1 not in match.pages:
+                            match.pages.append(page_num + 1)
+                        continue
+                    by_phash.append((phash, item))
+
+                by_xref[xref] = by_digest[digest] = item
+                unique_count += 1
+                yield item
+    finally:
+        doc.close()
+
+    print(
+        f"Images extracted successfully: {unique_count} unique, {len(skipped_xrefs)} skipped as too small."
+    )
+
+
+def extract_images_from_pdf(
+    pdf_file, min_side=MIN_IMAGE_SIDE, perceptual=False, max_distance=4
+):  # Removed the output_folder parameter
+    """Extracts unique images from a PDF file and returns a list of ExtractedImage objects."""
+    return list(iter_pdf_images(pdf_file, min_side, perceptual, max_distance))
+
+
+def page_content_region(page, padding=8):
+    """Returns the bounding box of everything drawn on the page (vectors, images and text)."""
+    import fitz
+
+    rects = [drawing["rect"] for drawing in page.get_drawings()]
+    rects += [fitz.Rect(info["bbox"]) for info in page.get_image_info()]
+    rects += [fitz.Rect(block[:4]) for block in page.get_text("blocks")]
+    rects = [rect for rect in rects if not rect.is_empty]
+    if not rects:
+        return None
 
+    region = fitz.Rect(rects[0])
+    for rect in rects[1:]:
+        region |= rect
+    region = fitz.Rect(
+        region.x0 - padding, region.y0 - padding, region.x1 + padding, region.y1 + padding
+    )
+    return region & page.rect
+
+
+def smallest_font_size(page, clip=None):
+    """Returns the smallest font size used on the page, or None when there is no text."""
+    sizes = [
+        span["size"]
+        for block in page.get_text("dict", clip=clip)["blocks"]
+        for line in block.get("lines", [])
+        for span in line["spans"]
+        if span["text"].strip()
+    ]
+    return min(sizes) if sizes else None
+
+
+def choose_render_dpi(
+    page,
+    clip=None,
+    dpis=RENDER_DPIS,
+    min_text_px=MIN_READABLE_TEXT_PX,
+    max_long_side=VISION_MAX_LONG_SIDE,
+    max_short_side=VISION_MAX_SHORT_SIDE,
+):
+    """Picks the lowest DPI at which the page's smallest text stays readable after the API downscales it."""
+    rect = clip or page.rect
+    font_size = smallest_font_size(page, clip) or 10  # Pure drawings: assume body text size
+
+    best_dpi, best_px = dpis[0], 0.0
+    for dpi in dpis:
+        width, height = rect.width * dpi / 72, rect.height * dpi / 72
+        # The model never sees more than this, so extra DPI past it buys nothing
+        scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+        text_px = font_size * dpi / 72 * scale
+        if text_px >= min_text_px:
+            return dpi
+        if text_px > best_px:
+            best_dpi, best_px = dpi, text_px
+    return best_dpi
+
+
+def is_text_only_page(page):
+    """True when the page has text but nothing drawn, so rendering it adds no information."""
+    return (
+        bool(page.get_text().strip())
+        and not page.get_images(full=True)
+        and not page.get_drawings()
+    )
+
+
+def iter_rendered_pages(pdf_file, dpi=None, crop=True, with_text=False):
+    """Lazily renders each page with visual content to a PNG ExtractedImage.
+
+    Text-only and blank pages are skipped, unless ``with_text`` is set, in which case
+    text-dominant pages are yielded as text-only items. When ``dpi`` is None the lowest
+    readable DPI is picked per page.
+    """
+    import fitz
 
-def extract_images_from_pdf(pdf_file):  # Removed the output_folder parameter
-    """Extracts images from a PDF file and returns a list of PIL Image objects."""
-    doc = fitz.open(stream=pdf_file, filetype="pdf")
+    with tracing.span("pdf.open", bytes=len(pdf_file)) as open_span:
+        doc = fitz.open(stream=pdf_file, filetype="pdf")
+        open_span.set(pages=doc.page_count)
+    rendered = skipped = 0
 
-    images = []  # Store PIL Image objects
+    try:
+        for page_num, page in enumerate(doc):
+            if with_text and is_text_dominant(page):
+                spans = extract_text_spans(page)
+                text = "\n".join(span["text"] for span in spans)
+                rendered += 1
+                yield ExtractedImage(
+                    None,
+                    "txt",
+                    0,
+                    hashlib.sha256(text.encode("utf-8")).hexdigest(),
+                    0,
+                    0,
+                    [page_num + 1],
+                    spans,
+                    text_only=True,
+                )
+                continue
+
+            if is_text_only_page(page):
+                skipped += 1
+                continue
+
+            clip = page_content_region(page) if crop else page.rect
+            if clip is None or clip.is_empty:
+                skipped += 1
+                continue
+
+            page_dpi = dpi or choose_render_dpi(page, clip)
+            with tracing.span("pdf.render_page", page=page_num + 1, dpi=page_dpi):
+                pixmap = page.get_pixmap(dpi=page_dpi, clip=clip)
+                image_bytes = pixmap.tobytes("png")
+
+            rendered += 1
+            yield ExtractedImage(
+                image_bytes,
+                "png",
+                0,  # Rendered pages have no xref of their own
+                hashlib.sha256(image_bytes).hexdigest(),
+                pixmap.width,
+                pixmap.height,
+                [page_num + 1],
+                extract_text_spans(page, clip=clip) if with_text else [],
+            )
+    finally:
+        doc.close()
 
-    for page_num, page in enumerate(doc):
-        for img_index, img in enumerate(page.get_images(full=True)):
-            xref = img[0]  # Image reference
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            # image_ext = base_image["ext"] # Removed the image extension
+    print(f"Pages rendered successfully: {rendered} rendered, {skipped} skipped.")
 
-            # Create a PIL Image object from the bytes
-            image = Image.open(io.BytesIO(image_bytes))
-            images.append(image)
 
-    print(f"Images extracted successfully.")
-    return images  # Return the list of PIL Image objects
+def iter_document_images(
+    pdf_file, mode="Auto", dpi=None, crop=True, perceptual=False, with_text=False
+):
+    """Yields images for analysis using embedded images, rendered pages, or embedded with a render fallback."""
+    if mode == "Render pages":
+        yield from iter_rendered_pages(pdf_file, dpi, crop, with_text)
+        return
 
+    found = False
+    for item in iter_pdf_images(pdf_file, perceptual=perceptual, with_text=with_text):
+        found = True
+        yield item
 
-def analyze_image_with_gpt4v(image):
-    """Analyzes an image with GPT-4V."""
-    prompt = """
-    Identify any fields, buttons and text in the screenshots and create user stories with acceptance criteria in BDD/Gherkin format from them.
-
-    Display Results as follows:
-
-    #### **User Story:**
-    #     As a [role], I want [feature] so that [benefit].
-
-    #     #### **Acceptance Criteria:**
-    #     - **Feature:** A brief description of the functionality
-    #       - **Scenario:** Provide a detailed name for each scenario.
-    #       - **Given:** Outline the preconditions necessary for the scenario.
-    #       - **When:** Specify the actions taken by the user.
-    #       - **Then:** State the expected results after the actions.
-
-    Requirements:
-    -DO NOT WRITE ETC, WRITE IN DETAIL AND WRITE FULL SENTENCES
-    -Also ensure all text fields and buttons and text are mentioned in the user stories and acceptance criteria.
-    -Do not use short forms or reduce the number of examples; include every option explicitly.
-    -Write out all details completely without omitting any examples or categories; include ALL of them.
-    -Write out all details completely without omitting any examples or categories; include ALL of them.
-    """
+    # Vector-only exports (Figma, Word) have no embedded rasters
+    if mode == "Auto" and not found:
+        yield from iter_rendered_pages(pdf_file, dpi, crop, with_text)
 
-    try:
+
+# Static, so it is an identical prefix on every vision request
+VISION_PROMPT = get_prompt("vision").prefix
+
+# Only the exact `### Image k` line the prompt asks for (optionally bold); deeper
+# headings such as `#### Image 1 Preview button` stay part of the story
+BATCH_SECTION_RE = re.compile(r"^[ \t]*###[ \t]+(\**)Image[ \t]+(\d+)\1[ \t]*:?[ \t]*$", re.M)
+
+
+def prepare_image_payload(
+    image,
+    max_long_side=VISION_MAX_LONG_SIDE,
+    max_short_side=VISION_MAX_SHORT_SIDE,
+    image_format=VISION_IMAGE_FORMAT,
+    quality=VISION_IMAGE_QUALITY,
+):
+    """Returns the bytes to upload for an image, re-encoding only when it is oversized or in an unsupported format."""
+    with tracing.span("image.encode") as encode_span:
+        payload = _prepare_image_payload(
+            image, max_long_side, max_short_side, image_format, quality
+        )
+        encode_span.set(
+            upload_bytes=payload["upload_bytes"], passthrough=payload["passthrough"]
+        )
+    return payload
+
+
+def _prepare_image_payload(image, max_long_side, max_short_side, image_format, quality):
+    from PIL import Image
+
+    start = time.perf_counter()
+
+    if isinstance(image, ExtractedImage):
+        data, ext, width, height = image.data, image.ext.lower(), image.width, image.height
+    else:
         if isinstance(image, str):
             # If image is a path, open it with PIL
-            pil_image = Image.open(image)
-        else:
-            # If image is already a PIL Image object, use it directly
-            pil_image = image
+            image = Image.open(image)
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        data, ext, (width, height) = buffered.getvalue(), "png", image.size
+
+    scale = min(
+        1.0,
+        max_long_side / max(width, height),
+        max_short_side / min(width, height),
+    )
+
+    if ext in ACCEPTED_IMAGE_EXTS and scale == 1.0:
+        mime = ACCEPTED_IMAGE_EXTS[ext]
+        passthrough = True
+    else:
+        pil_image = Image.open(io.BytesIO(data))
+        if scale < 1.0:
+            new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            pil_image = pil_image.resize(new_size, Image.LANCZOS)
+
+        if image_format.upper() == "JPEG" and pil_image.mode != "RGB":
+            # JPEG has no alpha channel, flatten onto white like a screenshot would be
+            background = Image.new("RGB", pil_image.size, (255, 255, 255))
+            rgba = pil_image.convert("RGBA")
+            background.paste(rgba, mask=rgba.split()[-1])
+            pil_image = background
 
         buffered = io.BytesIO()
-        pil_image.save(buffered, format="PNG")
-        img_bytes = buffered.getvalue()
-
-        # Send image to OpenAI's GPT-4V
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64.b64encode(img_bytes).decode()}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=1000,
+        pil_image.save(buffered, format=image_format.upper(), quality=quality)
+        data = buffered.getvalue()
+        mime = f"image/{image_format.lower()}"
+        passthrough = False
+
+    return {
+        "data": data,
+        "mime": mime,
+        "passthrough": passthrough,
+        "upload_bytes": len(data),
+        "encode_ms": (time.perf_counter() - start) * 1000,
+    }
+
+
+def format_text_layer(spans, max_chars=6000):
+    """Formats text spans as compact prompt lines: text @ [x0,y0,x1,y1]."""
+    lines = []
+    total = 0
+    for span in spans:
+        line = f"{span['text']} @ {span['bbox']}"
+        total += len(line) + 1
+        if total > max_chars:
+            lines.append("(text layer truncated)")
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _vision_input(image, vision_mode):
+    """Prepares one image for the vision model. Returns (text_layer, images, stats, cache_key).
+
+    ``text_layer`` is the formatted text layer in hybrid mode, else None.
+    """
+    hybrid = (
+        vision_mode != "Image only"
+        and isinstance(image, ExtractedImage)
+        and (image.text_spans or image.text_only)
+    )
+
+    text_layer = None
+    images = []
+    stats = {"upload_bytes": 0, "encode_ms": 0.0, "passthrough": True, "cached": False}
+
+    if hybrid:
+        text_layer = format_text_layer(image.text_spans)
+        stats["image_only_tokens"] = (
+            None if image.text_only else estimate_image_tokens(image.width, image.height)
         )
-        return response.choices[0].message.content
+
+    if isinstance(image, ExtractedImage) and image.text_only:
+        image_key = image.digest.encode()
+    else:
+        if hybrid:
+            payload = prepare_image_payload(
+                image, HYBRID_MAX_LONG_SIDE, HYBRID_MAX_SHORT_SIDE
+            )
+        else:
+            payload = prepare_image_payload(image)
+        stats.update(
+            upload_bytes=payload["upload_bytes"],
+            encode_ms=payload["encode_ms"],
+            passthrough=payload["passthrough"],
+        )
+        image_key = payload["data"]
+        images.append({"mime": payload["mime"], "data": payload["data"]})
+
+    cache_key = make_cache_key(image_key, single_image_prompt(text_layer), VISION_MODEL)
+    return text_layer, images, stats, cache_key
+
+
+def single_image_prompt(text_layer):
+    if text_layer is None:
+        return VISION_PROMPT
+    return VISION_PROMPT + get_prompt("vision_text_layer").render(text_layer=text_layer)
+
+
+def _cached_story(cache_key, stats):
+    """Returns the cached story for a vision input (recording the hit in stats), or None."""
+    cached = vision_cache.get(cache_key)
+    if cached is None:
+        return None
+    stats["cached"] = True
+    if isinstance(cached, str):  # Entries written before usage was recorded
+        return cached
+    stats["usage"] = cached.get("usage")
+    return cached["story"]
+
+
+def _analyze_image(image, vision_mode="Image only"):
+    """Analyzes an image with GPT-4V and raises on failure. Returns (story, stats)."""
+    text_layer, images, stats, cache_key = _vision_input(image, vision_mode)
+    # Sessions analysing the same image at once wait for the first request's answer
+    with vision_cache.lock(cache_key):
+        story = _cached_story(cache_key, stats)
+        if story is not None:
+            return story, stats
+        return _request_story(text_layer, images, stats, cache_key)
+
+
+def _request_story(text_layer, images, stats, cache_key):
+    # Send image to OpenAI's GPT-4V
+    completion = get_provider("openai").complete(
+        single_image_prompt(text_layer),
+        VISION_MODEL,
+        images=images,
+        max_tokens=VISION_MAX_OUTPUT_TOKENS,
+        stage="vision",
+    )
+    story = completion.text
+    stats["usage"] = {
+        "input_tokens": completion.input_tokens,
+        "output_tokens": completion.output_tokens,
+    }
+    if story:
+        vision_cache.set(cache_key, {"story": story, "usage": stats.get("usage")})
+    return story, stats
+
+
+def split_batch_response(text, count, truncated=False):
+    """Splits a multi-image answer on its `### Image k` headings into count stories (None where missing).
+
+    When the answer was ``truncated``, its last section is cut off and counts as missing.
+    """
+    stories = [None] * count
+    matches = list(BATCH_SECTION_RE.finditer(text or ""))
+    sections = list(zip(matches, matches[1:] + [None]))
+    if truncated:
+        sections = sections[:-1]
+    for match, following in sections:
+        k = int(match.group(2)) - 1
+        body = text[match.end():following.start() if following else len(text)].strip()
+        if 0 <= k < count and body and stories[k] is None:
+            stories[k] = body
+    return stories
+
+
+def _analyze_image_batch(batch, vision_mode="Image only"):
+    """Analyzes several images in one request and raises on failure. Returns [(story, stats)] in order.
+
+    Cached images are answered from the cache; images the answer could not be
+    split out for are analysed on their own.
+    """
+    prepared = [_vision_input(image, vision_mode) for image in batch]
+    results = [None] * len(batch)
+    pending = []
+    for i, (text_layer, images, stats, cache_key) in enumerate(prepared):
+        story = _cached_story(cache_key, stats)
+        if story is not None:
+            results[i] = (story, stats)
+        else:
+            pending.append(i)
+    if len(pending) < 2:
+        for i in pending:
+            results[i] = _request_story(*prepared[i])
+        return results
+
+    prompt = VISION_PROMPT + get_prompt("vision_batch").render(count=len(pending))
+    images = []
+    for k, i in enumerate(pending, 1):
+        text_layer = prepared[i][0]
+        if text_layer is not None:
+            prompt += get_prompt("vision_batch_text_layer").render(k=k, text_layer=text_layer)
+        images += prepared[i][1]
+
+    completion = get_provider("openai").complete(
+        prompt,
+        VISION_MODEL,
+        images=images,
+        max_tokens=VISION_MAX_OUTPUT_TOKENS * len(pending),
+        stage="vision_batch",
+    )
+    # The request's usage is split evenly across the images that shared it
+    usage = {
+        "input_tokens": completion.input_tokens // len(pending),
+        "output_tokens": completion.output_tokens // len(pending),
+    }
+    stories = split_batch_response(
+        completion.text, len(pending), truncated=is_truncated(completion.finish_reason)
+    )
+    for i, story in zip(pending, stories):
+        if story is None:
+            print(f"No section for image {pending.index(i) + 1} of a batch, analysing it alone")
+            results[i] = _request_story(*prepared[i])
+            continue
+        stats = prepared[i][2]
+        stats.update(usage=usage, batched=len(pending))
+        vision_cache.set(prepared[i][3], {"story": story, "usage": usage})
+        results[i] = (story, stats)
+    return results
+
+
+def estimate_vision_tokens(image, vision_mode):
+    """Rough input tokens an image adds to a vision request, or None if it cannot share a request."""
+    if not isinstance(image, ExtractedImage) or image.text_only:
+        return None
+    tokens = estimate_image_tokens(image.width, image.height)
+    if vision_mode != "Image only" and image.text_spans:
+        tokens += estimate_tokens(format_text_layer(image.text_spans))
+    return tokens
+
+
+def manifest_image_key(image, vision_mode):
+    """Identifies what the vision model sees for an image, so it can be matched across uploads."""
+    text_layer = repr(image.text_spans) if vision_mode != "Image only" else ""
+    return make_cache_key(image.digest, vision_mode, text_layer, VISION_PROMPT, VISION_MODEL)
+
+
+def analyze_image_with_gpt4v(image):
+    """Analyzes an image with GPT-4V."""
+    try:
+        story, _ = _analyze_image(image)
+        return story
     except Exception as e:
         st.error(f"Error analyzing image: {e}")
         return None
 
 
+def analyze_images_concurrently(
+    images,
+    max_workers=VISION_CONCURRENCY,
+    on_submit=None,
+    vision_mode="Image only",
+    cancel_event=None,
+    reuse=None,
+    batch_size=VISION_BATCH_SIZE,
+):
+    """Analyzes images on a bounded thread pool, yielding (index, story, stats, error) as each one finishes.
+
+    ``images`` may be a lazy iterator; analysis of early images starts while later
+    ones are still being extracted. ``on_submit(index, image)`` runs in the calling
+    thread as each image is handed to the pool. Once ``cancel_event`` is set, no
+    more images are submitted and those still waiting for a worker are cancelled.
+    ``reuse(image)`` may return a stored {"story", "usage"} to skip the model call.
+    With ``batch_size`` > 1, up to that many images from consecutive pages share
+    one request, within VISION_BATCH_TOKEN_BUDGET estimated input tokens.
+    """
+    # Streamlit calls are not allowed from worker threads, so errors are handed back
+    # to the caller instead of going through st.error
+    def analyze(group):
+        results = [None] * len(group)
+        pending = []
+        for i, image in enumerate(group):
+            stored = reuse(image) if reuse else None
+            if stored:
+                results[i] = (stored["story"], {
+                    "upload_bytes": 0,
+                    "encode_ms": 0.0,
+                    "passthrough": True,
+                    "cached": True,
+                    "reused": True,
+                    "usage": stored.get("usage"),
+                }, None)
+            else:
+                pending.append(i)
+
+        pages = sorted({page for i in pending for page in getattr(group[i], "pages", [])})
+        try:
+            if len(pending) == 1:
+                with tracing.span("vision.image", pages=pages) as image_span:
+                    story, stats = _analyze_image(group[pending[0]], vision_mode)
+                    image_span.set(cached=stats["cached"])
+                analysed = [(story, stats)]
+            elif pending:
+                with tracing.span("vision.batch", pages=pages, images=len(pending)):
+                    analysed = _analyze_image_batch([group[i] for i in pending], vision_mode)
+            else:
+                analysed = []
+            for i, (story, stats) in zip(pending, analysed):
+                results[i] = (story, stats, None)
+        except Exception as e:
+            for i in pending:
+                results[i] = (None, None, e)
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+
+        def results_of(future):
+            indices = futures.pop(future)
+            try:
+                for index, result in zip(indices, future.result()):
+                    yield (index, *result)
+            except Exception as e:
+                for index in indices:
+                    yield index, None, None, e
+
+        def finished():
+            for future in [future for future in futures if future.done()]:
+                yield from results_of(future)
+
+        def cancel_pending():
+            if cancel_event is None or not cancel_event.is_set():
+                return False
+            for future in futures:
+                future.cancel()
+            return True
+
+        group = []
+        group_tokens = 0
+
+        def submit():
+            nonlocal group, group_tokens
+            # Copy the context so the worker's spans nest under the caller's span
+            future = executor.submit(
+                contextvars.copy_context().run, analyze, [image for _, image in group]
+            )
+            futures[future] = [index for index, _ in group]
+            group, group_tokens = [], 0
+
+        for index, image in enumerate(images):
+            if cancel_pending():
+                group = []
+                break
+            if on_submit:
+                on_submit(index, image)
+
+            tokens = estimate_vision_tokens(image, vision_mode) if batch_size > 1 else None
+            if group and (
+                tokens is None
+                or len(group) >= batch_size
+                or group_tokens + tokens > VISION_BATCH_TOKEN_BUDGET
+                # Only neighbouring pages (one flow) share a request
+                or min(image.pages) > max(group[-1][1].pages) + 1
+            ):
+                submit()
+            group.append((index, image))
+            group_tokens += tokens or 0
+            if tokens is None or len(group) >= batch_size:
+                submit()
+            yield from finished()
+        if group:
+            submit()
+
+        for future in as_completed(list(futures)):
+            cancel_pending()
+            yield from results_of(future)
+
+
 def generate_orm_context(database, orms, programming_language):
     """Generates context for ORM usage based on database and ORM choice."""
 
@@ -153,57 +875,91 @@ def generate_boilerplate(
     try:
         orm_context = generate_orm_context(database, orms, programming_language)
 
-        prompt_boiler_plate_creation = f"""
-        ## Prompt for API Boilerplate Code Generation
-
-        **Instructions:**
-        You are an AI code generation assistant. Your task is to generate *only* the boilerplate code of the API based on the provided user stories, programming language, API framework, Database, ORMs (if any), and the actual schema in YAML format, and additional instructions. Do *not* include any explanatory text, comments outside of the code itself, or any other information besides the code. Ensure the generated code is well-structured, readable, and follows best practices for the chosen language and framework. Include necessary error handling and consider security implications where applicable. Assume all necessary libraries and dependencies are pre-installed. Focus on providing a functional boilerplate for an API implementation.
-        
-
-        **Important Instructions**
-        - Further ensure that the API includes CORS policy with allow-all origins. And further include any other security considerations.
-        - Further ensure there are GET requests for each respective POST request.
-
-        **Input:**
-        1. **User Stories:**
-        {user_stories}
-
-        2. **Programming Language:**
-        {programming_language}
-
-        3. **API Framework:**
-        {framework}
-
-        If the provided framework has issues or is not provided, then choose the best framework for the given programming language.
-        
-        4. **Database:**
-        {database}
-        
-        5. **ORM:**
-        {orm_context}
-
-        6. **YAML Schema:**
-        {yaml_generated}
-        
-        7. **Additional Instructions:**
-        {additional_instructions}
-
-        **Output:**
-        Provide *only* the boilerplate code with the stated database above defined and API definitions.
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt_boiler_plate_creation}],
-            max_tokens=2000,
+        prompt_boiler_plate_creation = get_prompt("boilerplate").render(
+            user_stories=user_stories,
+            programming_language=programming_language,
+            framework=framework,
+            database=database,
+            orm_context=orm_context,
+            yaml_generated=yaml_generated,
+            additional_instructions=additional_instructions,
+        )
+
+        # Compact spec for resumes of a truncated answer
+        spec = (
+            f"{programming_language} API boilerplate using {framework}, "
+            f"{database} database, ORM: {orms}."
         )
-        return response.choices[0].message.content, prompt_boiler_plate_creation
+        prompt = prompt_boiler_plate_creation
+        for attempt in range(VALIDATION_RETRIES + 1):
+            completion = get_provider("openai").complete(
+                prompt, BOILERPLATE_MODEL, max_tokens=2000, stage="boilerplate"
+            )
+            boilerplate, finish_reason = completion.text, completion.finish_reason
+            continuations = 0
+            while is_truncated(finish_reason) and continuations < MAX_CONTINUATIONS:
+                print("Boilerplate truncated, resuming from its tail")
+                resumed = complete_code(boilerplate, spec)
+                if resumed is None:
+                    break
+                remaining_code, _, finish_reason = resumed
+                boilerplate += strip_overlap(boilerplate, remaining_code)
+                continuations += 1
+            if is_truncated(finish_reason):
+                # Cut off rather than wrong, so feedback about syntax would not help
+                st.error("Generated boilerplate was cut off and could not be completed.")
+                return None
+
+            problems = validation_problems(boilerplate, programming_language)
+            if not problems:
+                break
+            print(f"Boilerplate failed validation (attempt {attempt + 1}): {problems}")
+            prompt = prompt_boiler_plate_creation + validation_feedback(problems)
+        else:
+            # Broken boilerplate would be carried into every story's code
+            st.error(
+                f"Generated boilerplate is still invalid after {VALIDATION_RETRIES + 1} attempts: "
+                + "; ".join(problems)
+            )
+            return None
+        return boilerplate, prompt_boiler_plate_creation
 
     except Exception as e:
         st.error(f"Error generating boilerplate code: {e}")
         return None
 
 
+def validation_feedback(problems):
+    return get_prompt("validation_feedback").render(
+        problems="\n".join(f"- {problem}" for problem in problems)
+    )
+
+
+def validation_problems(code, programming_language):
+    """Returns why generated code fails local checks (only Python is compiled), or []."""
+    if programming_language.lower() != "python":
+        return []
+    with tracing.span("validate.python"):
+        try:
+            validate_python(code)
+        except ValidationError as e:
+            return e.problems
+    return []
+
+
+def is_truncated(finish_reason):
+    """True when generation stopped because it ran out of output tokens."""
+    return finish_reason == "MAX_TOKENS"
+
+
+def strip_overlap(existing, continuation, max_overlap=1000):
+    """Drops the start of continuation when the model repeats the end of existing."""
+    for size in range(min(max_overlap, len(existing), len(continuation)), 0, -1):
+        if existing.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
+
 def generate_api_code(
     user_story,
     boiler_plate="",
@@ -214,106 +970,114 @@ def generate_api_code(
     database="PostgreSQL",
     orms="SQLAlchemy",
     yaml_generated="",
+    on_chunk=None,
 ):
-    """Generates API code based on extracted user stories using Gemini 2.0 Flash, with context."""
+    """Generates API code based on extracted user stories using Gemini 2.0 Flash, with context.
+
+    The response is streamed; ``on_chunk(text_so_far)`` is called as it arrives.
+    """
     try:
         context = ""
         if combined_user_stories:
-            # context = f"""
-            # Previous Image User Stories and Acceptance Criterias:
-            # {combined_user_stories}
-
-            # Previous Generated Code that you need to build upon:
-            # {previous_code}
-            # """
-
-            context = f"""
-            Previous Image User Stories and Acceptance Criterias that were used to build the code provided below:
-            {combined_user_stories}
-            """
-
-        prompt_api_creation = f"""
-        ## Prompt for API Code Generation (Code-Only Output)
-
-        **Instructions:**
-
-        You are an AI code generation assistant. Your task is to generate the API code given the boilerplate, detailed user story and acceptance criteria, programming language, API framework, and additional instructions.  Consider the previous context of user stories and code when generating the API for this current user story.  Do *not* include any explanatory text, comments outside of the code itself, or any other information besides the code. Ensure the generated code is well-structured, readable, and follows best practices for the chosen language and framework. Include necessary error handling and consider security implications where applicable. Assume all necessary libraries and dependencies are pre-installed. Focus on providing a functional API implementation.
-        Replace any comments that says "Simulate the logic by yourself", "Add the logic by yourself", etc. These type of comments should be replaced with the correct implementation based on the userstories and best practices.
-        If the code is using raw dictionaries and manual data retrieval/storage, replace them with {orms}-based queries while following {database}'s best practices.
-        
-        Also if any API is not implemented in the boilerplate, please implement it in the final code given the User story and Gherkin.
-
-        **Important Instructions:**
-        - Avoid reusing similar logic, instead use functions or reusable components where necessary. 
-        - Ensure the code remains within 800 lines, avoiding unnecessary verbosity while maintaining readability and completeness.
-        - Further ensure that the API includes CORS policy with allow-all origins. And further include any other security considerations.
-        - Further ensure there are GET requests for each respective POST request.
-        - Ensure the outputs are not mock-up dictionaries but actual data from the database.
-
-        {context}  <-- Previous context
-
-        **Input:**
-
-        1. **Previously produced Code that you need to build upon:**
-        This code contains placeholder comments and logic that needs to be replaced with the implementation.
-        {boiler_plate}
-
-        2. **User Story and Gherkin:**
-        {user_story}
-
-        3. **Programming Language:**
-        {programming_language}
-
-        4. **API Framework:**
-        {framework}
-
-        5. **Database**
-        {database}
-        
-        6. **ORM**
-        {orms}
-
-        7. **YAML Schema:**
-        {yaml_generated}
-
-        If the provided framework has issues or is not provided, then choose the best framework for the given programming language.
-
-        8. **Additional Instructions:**
-        {additional_instructions}
+            context = get_prompt("code_context").render(
+                combined_user_stories=combined_user_stories
+            )
 
-        **Expected Output:**
-        1. Provide only the complete and functional API code in the specified programming language and framework. Include necessary imports, function definitions, routing, middleware (if applicable), and any other required code.
-        2. A complete, functional version of the given code with placeholder comments replaced by actual logic.
-        3. Any necessary ORM-based data handling instead of dictionary-based storage.
-        4. Proper adherence to {framework} best practices.
-        
-        """
+        prompt_api_creation = get_prompt("code").render(
+            context=context,
+            boiler_plate=boiler_plate,
+            user_story=user_story,
+            programming_language=programming_language,
+            framework=framework,
+            database=database,
+            orms=orms,
+            yaml_generated=yaml_generated,
+            additional_instructions=additional_instructions,
+        )
 
-        client_gemini = genai.Client(api_key=GEMINI_API_KEY)
-        response = client_gemini.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt_api_creation,
+        completion = get_provider("gemini").stream(
+            prompt_api_creation,
+            CODE_MODEL,
             config={
                 "temperature": 0.3,  # 0 to 2
                 "top_p": 0.9,
                 "top_k": 50,
             },
+            on_chunk=on_chunk,
+            stage="code",
         )
 
-        # genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        return (
+            completion.text,
+            completion.output_tokens,
+            prompt_api_creation,
+            completion.input_tokens,
+            completion.finish_reason,
+        )
 
-        # model = genai.GenerativeModel('gemini-2.0-flash') # Using Gemini 1.5 Flash
+    except Exception as e:
+        st.error(f"Error generating API code: {e}")
+        return None
+
+
+def generate_api_code_patch(
+    user_story,
+    boiler_plate="",
+    programming_language="Python",
+    framework="Flask",
+    additional_instructions="",
+    combined_user_stories="",
+    database="PostgreSQL",
+    orms="SQLAlchemy",
+    yaml_generated="",
+    on_chunk=None,
+):
+    """Asks for SEARCH/REPLACE blocks against the current code and applies them locally.
 
-        # response = model.generate_content(prompt_api_creation, request_options={"timeout":1000})
+    Takes the same arguments and returns the same tuple as generate_api_code, or
+    None when the patch cannot be generated, applied or validated.
+    """
+    try:
+        context = ""
+        if combined_user_stories:
+            context = get_prompt("code_context").render(
+                combined_user_stories=combined_user_stories
+            )
+
+        prompt_api_patch = get_prompt("code_patch").render(
+            context=context,
+            boiler_plate=boiler_plate,
+            user_story=user_story,
+            programming_language=programming_language,
+            framework=framework,
+            database=database,
+            orms=orms,
+            yaml_generated=yaml_generated,
+            additional_instructions=additional_instructions,
+        )
+
+        completion = get_provider("gemini").stream(
+            prompt_api_patch,
+            CODE_MODEL,
+            config={"temperature": 0.3, "top_p": 0.9, "top_k": 50},
+            on_chunk=on_chunk,
+            stage="code_patch",
+        )
+        if is_truncated(completion.finish_reason):
+            raise PatchError("patch was truncated")
+        api_code = apply_patch(boiler_plate, parse_patch(completion.text))
+        validate_code(api_code, programming_language)
 
         return (
-            response.text,
-            response.usage_metadata.candidates_token_count,
-            prompt_api_creation,
+            api_code,
+            completion.output_tokens,
+            prompt_api_patch,
+            completion.input_tokens,
+            completion.finish_reason,
         )
 
     except Exception as e:
-        st.error(f"Error generating API code: {e}")
+        print(f"Patch not usable ({e}), regenerating the full code")
         return None
 
 
@@ -321,99 +1085,39 @@ def generate_yaml_schema(
     user_story,
     combined_user_stories,
     previous_yaml_schema="",
+    feedback="",
 ):
     """Generates yaml schema based on extracted user stories using Gemini 2.0 Flash, with context."""
     try:
-        system_prompt = """
-        You are an expert database architect, specializing in creating practical, efficient relational schemas.
-        Your priority is to ensure the schema is normalized and clean, but avoid overcomplication, especially with unnecessary junction tables.
-        """
+        system_prompt = get_prompt("schema_system").prefix
 
         context = ""
         if combined_user_stories:
-            context = f"""
-            Previous Image User Stories and Acceptance Criterias that were used to generate the current schema:
-            {combined_user_stories}
-            """
-
-        prompt_schema_creation = f"""
-        ## Prompt for Schema Code Generation (YAML)
-
-       You are an expert database schema designer. Your task is to generate a well-structured, normalized (3NF) relational database schema in YAML format based on provided user stories and their corresponding acceptance criteria, I have also generated the previously generated yaml schema for reference so please edit it and add to it. Focus on creating a schema that minimizes redundancy, ensures data integrity, and avoids excessive columns per table.
-
-        **Instructions:**
-
-        1.  **Analyze User Story and Acceptance Criteria:** Carefully analyze the provided user story and its acceptance criteria to identify all entities, attributes, and relationships necessary to fulfill the requirements.
-        2.  **Identify Entities and Attributes:** Extract distinct entities and their relevant attributes from the user story.
-        3.  **Determine Relationships:** Identify the relationships between entities (one-to-one, one-to-many, many-to-many).
-        4.  **Normalize to 3NF:** Design the schema in 3rd Normal Form (3NF) by:
-            * Ensure the tables does not have exceedingly large number of columns.
-            * Stick to 3NF, **but don’t overdo it**. If a table gets too fragmented or introduces too many unnecessary joins, intelligently **merge tables**.  
-        5.  **Minimize Columns:** Strive to create tables with a reasonable number of columns. 
-        6.  **Define Primary and Foreign Keys:** Clearly define primary keys for each table and establish foreign key relationships to enforce referential integrity.
-        7.  **Data Types:** Select appropriate data types for each attribute based on the nature of the data.
-        8.  **Output Format:** Provide the schema in YAML format, clearly defining tables, columns, data types, primary keys, and foreign keys.
-        9. **Assume Best Practices:** Adhere to database design best practices, including proper naming conventions and data type selection.
-        10. **Focus on Data Structure:** Focus solely on the schema structure, without considering specific database engine syntax or implementation details unless absolutely necessary to define a datatype.
-        11. **Handle Many-to-Many: Use junction tables **only** when the many-to-many relationship is complex or needs additional data. For simple relationships, prioritize **direct foreign keys**.
-        
-        **Context**
-
-        {context}  <-- Previous context
-
-        **Input:**
-
-        1. **Previously produced Schema that you need to build upon:**
-        This schema may have incomplete information and may need to be updated based on the new user stories.
-        {previous_yaml_schema}
-
-        2. **User Story and Gherkin:**
-        {user_story}
-
-        **Expected Output:**
-        Deliver only the schema in clean YAML format (no explanations)
-        Define tables, columns, data types, primary keys, and foreign keys.  
-        Example Schema that your final table may look like, basically use it as reference for the structure for the YAML file, do not copy it as it is or replicate it:
-        ```yaml
-        tables:
-            users:
-                columns:
-                - id:
-                    type: Integer
-                    primary_key: true
-                - name:
-                    type: String(100)
-                - email:
-                    type: String(150)
-                    unique: true
-                relationships:
-                - user_teams:
-                    type: one_to_many
-                    related_table: user_teams
-                    foreign_key: user_id
-                - tasks:
-                    type: one_to_many
-                    related_table: tasks
-                    foreign_key: assigned_to
-
-            
-        """
-
-
-        client_gemini = genai.Client(api_key=GEMINI_API_KEY)
-        response = client_gemini.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[system_prompt, prompt_schema_creation],
-             config={
-                 "temperature": 0.3,  # 0 to 2
-                 "top_p": 0.9,
-                 "top_k": 50,
-             },
+            context = get_prompt("schema_context").render(
+                combined_user_stories=combined_user_stories
+            )
+
+        prompt_schema_creation = get_prompt("schema").render(
+            context=context,
+            previous_yaml_schema=previous_yaml_schema,
+            user_story=user_story,
+        ) + feedback
+
+        completion = get_provider("gemini").complete(
+            [system_prompt, prompt_schema_creation],
+            SCHEMA_MODEL,
+            config={
+                "temperature": 0.3,  # 0 to 2
+                "top_p": 0.9,
+                "top_k": 50,
+            },
+            stage="schema",
         )
-        
+
         return (
-            response.text,
-            response.usage_metadata.candidates_token_count,
+            completion.text,
+            completion.output_tokens,
+            completion.input_tokens,
         )
 
     except Exception as e:
@@ -421,219 +1125,933 @@ def generate_yaml_schema(
         return None
  
 
-def complete_code(past_chat):
-    """Completes the unfinshed code based on the past chat."""
-    try:
-        prompt_api_creation = f"""
-        You are an AI completing unfinished code. Below is the conversation history and the incomplete code. Your task is to continue the code from where it was left off without repeating any previous content.
-
-        Instructions:
+def generate_valid_yaml_schema(user_story, combined_user_stories, previous_yaml_schema=""):
+    """Runs one schema step and retries only that step while its YAML fails validation.
 
-        1. Do not repeat any part of the already generated code.
-        2. Do not add explanations or comments—only output the remaining unfinished code.
-        3. Maintain the original style and structure of the code.
-        
-        Conversation History & Incomplete Code:
-        {past_chat}
-
-        Now, continue the code from where it left off. Output only the remaining unfinished code and nothing else.
-        """
+    Returns (yaml_without_fences, output_tokens, input_tokens) or None.
+    """
+    feedback = ""
+    for attempt in range(VALIDATION_RETRIES + 1):
+        result = generate_yaml_schema(
+            user_story, combined_user_stories, previous_yaml_schema, feedback
+        )
+        if result is None:
+            return None
+        with tracing.span("validate.schema"):
+            try:
+                clean_yaml, _ = validate_schema(result[0])
+                return (clean_yaml,) + result[1:]
+            except ValidationError as e:
+                print(f"Schema failed validation (attempt {attempt + 1}): {e}")
+                feedback = validation_feedback(e.problems)
+    st.error(f"Generated schema is still invalid after {VALIDATION_RETRIES + 1} attempts.")
+    return None
+
+
+def schema_chain_keys(user_stories):
+    """Returns one chained key per story: step i depends on every story up to i."""
+    keys = []
+    previous = ""
+    for story in user_stories:
+        previous = make_cache_key(previous, story, SCHEMA_MODEL, SCHEMA_PROMPT_VERSION)
+        keys.append(previous)
+    return keys
+
+
+def build_yaml_schema_chain(user_stories, memo=None, on_step=None):
+    """Builds the YAML schema for the ordered stories, resuming from the longest cached prefix.
+
+    ``memo`` is an optional in-memory dict (e.g. st.session_state) checked before
+    the disk cache. ``on_step(done, total)`` runs before each generated step and
+    once at the end. Returns (yaml_schema, reused_steps, generated_steps,
+    input_tokens), where input_tokens lists the prompt tokens of each generated step.
+    """
+    memo = memo if memo is not None else {}
+    keys = schema_chain_keys(user_stories)
+
+    # Walk back from the full chain to find the longest prefix we already have
+    start = 0
+    yaml_generated = ""
+    for i in range(len(keys) - 1, -1, -1):
+        cached = memo.get(keys[i])
+        if cached is None:
+            cached = schema_cache.get(keys[i])
+        if cached is not None:
+            start = i + 1
+            yaml_generated = cached
+            memo[keys[i]] = cached
+            break
+
+    input_tokens = []
+    for i in range(start, len(user_stories)):
+        if on_step:
+            on_step(i, len(user_stories))
+        with schema_cache.lock(keys[i]):
+            # Another session may have built this step while we waited
+            cached = schema_cache.get(keys[i], count_miss=False)
+            if cached is not None:
+                yaml_generated = memo[keys[i]] = cached
+                continue
+            # Only a bounded, relevance-ranked view of earlier stories goes into the prompt
+            story_context = build_story_context(user_stories[:i], user_stories[i])
+            result = generate_valid_yaml_schema(user_stories[i], story_context, yaml_generated)
+            if result is None:
+                # Keep the last good schema; the failed step is retried on the next rerun
+                return yaml_generated, start, i - start, input_tokens
+            yaml_generated, token_count, prompt_tokens = result
+            input_tokens.append(prompt_tokens)
+            memo[keys[i]] = yaml_generated
+            schema_cache.set(keys[i], yaml_generated)
+
+    if on_step:
+        on_step(len(user_stories), len(user_stories))
+    return yaml_generated, start, len(user_stories) - start, input_tokens
+
+
+def update_yaml_schema(base_yaml, user_stories, changed):
+    """Extends the schema of an earlier version of the document with only the new or changed stories.
+
+    Returns the same tuple as build_yaml_schema_chain.
+    """
+    yaml_generated = base_yaml
+    input_tokens = []
+    reused = len(user_stories) - len(changed)
+    for step, i in enumerate(changed):
+        others = user_stories[:i] + user_stories[i + 1:]
+        story_context = build_story_context(others, user_stories[i])
+        result = generate_valid_yaml_schema(user_stories[i], story_context, yaml_generated)
+        if result is None:
+            return yaml_generated, reused, step, input_tokens
+        yaml_generated, token_count, prompt_tokens = result
+        input_tokens.append(prompt_tokens)
+    return yaml_generated, reused, len(changed), input_tokens
+
+
+def complete_code(unfinished_code, spec="", tail_chars=CONTINUATION_TAIL_CHARS, on_chunk=None):
+    """Continues truncated code from its tail plus a compact spec. Returns (text, token_count, finish_reason)."""
+    try:
+        prompt_api_creation = get_prompt("code_continuation").render(
+            spec=spec, tail=unfinished_code[-tail_chars:]
+        )
 
-        client_gemini = genai.Client(api_key=GEMINI_API_KEY)
-        response = client_gemini.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt_api_creation,
+        completion = get_provider("gemini").stream(
+            prompt_api_creation, CODE_MODEL, on_chunk=on_chunk, stage="code_continuation"
         )
 
-        return response.text, response.usage_metadata.candidates_token_count
+        return completion.text, completion.output_tokens, completion.finish_reason
 
     except Exception as e:
         st.error(f"Error generating API code: {e}")
         return None
 
 
-def main():
-    st.title("Takim User Story Creator")
-    st.write("Upload a PDF to receive user stories using GPT-4V.")
+def generate_complete_api_code(spec, *args, on_chunk=None, patch=False, **kwargs):
+    """Runs generate_api_code and resumes it from the tail while the output is truncated.
 
-    uploaded_file = st.file_uploader("Upload PDF", type=["pdf"])
+    With ``patch``, a SEARCH/REPLACE patch against the current code is tried first
+    and full generation is the fallback. Python output that does not compile is
+    regenerated for this story only, with the errors as feedback. Returns the
+    same tuple as generate_api_code, with the continuations appended to the code.
+    """
+    call = inspect.signature(generate_api_code).bind(*args, **kwargs)
+    call.apply_defaults()
+    call.arguments.pop("on_chunk")
+    instructions = call.arguments["additional_instructions"]
+    for attempt in range(VALIDATION_RETRIES + 1):
+        result = _generate_complete_api_code(
+            spec, *call.args, on_chunk=on_chunk, patch=patch and attempt == 0, **call.kwargs
+        )
+        if result is None:
+            return None
+        problems = validation_problems(result[0], call.arguments["programming_language"])
+        if not problems:
+            return result
+        print(f"API code failed validation (attempt {attempt + 1}): {problems}")
+        call.arguments["additional_instructions"] = instructions + validation_feedback(problems)
+    st.error(f"Generated code is still invalid after {VALIDATION_RETRIES + 1} attempts.")
+    return None
+
+
+def _generate_complete_api_code(spec, *args, on_chunk=None, patch=False, **kwargs):
+    if patch:
+        result = generate_api_code_patch(*args, on_chunk=on_chunk, **kwargs)
+        if result is not None:
+            return result
+    result = generate_api_code(*args, on_chunk=on_chunk, **kwargs)
+    if result is None:
+        return None
+    api_code, token_count, prompt_api_code, prompt_tokens, finish_reason = result
+
+    continuations = 0
+    while is_truncated(finish_reason) and continuations < MAX_CONTINUATIONS:
+        print(f"Output truncated, resuming from the last {CONTINUATION_TAIL_CHARS} characters")
+        base = api_code
+        resumed = complete_code(
+            base,
+            spec,
+            on_chunk=(lambda text: on_chunk(base + text)) if on_chunk else None,
+        )
+        if resumed is None:
+            break
+        remaining_code, token_count, finish_reason = resumed
+        api_code = base + strip_overlap(base, remaining_code)
+        continuations += 1
+
+    return api_code, token_count, prompt_api_code, prompt_tokens, finish_reason
+
+
+def session_pipeline(file_key):
+    """Returns the stage results stored in st.session_state for one uploaded file."""
+    pipelines = st.session_state.setdefault("pipelines", {})
+    return pipelines.setdefault(file_key, {})
+
+
+def cached_stage(pipeline, name, inputs):
+    """Returns the stored result of a stage if it was computed from the same inputs, else None."""
+    entry = pipeline.get(name)
+    if entry and entry["key"] == make_cache_key(*[repr(value) for value in inputs]):
+        return entry["result"]
+    return None
+
+
+def store_stage(pipeline, name, inputs, result):
+    """Stores a stage result together with the key of the inputs it was computed from."""
+    pipeline[name] = {
+        "key": make_cache_key(*[repr(value) for value in inputs]),
+        "result": result,
+    }
+
+
+def render_image_result(result):
+    """Renders the story, upload/encode stats and errors for one analysed image."""
+    stats = result["stats"]
+    if stats:
+        st.caption(
+            f"Upload: {stats['upload_bytes'] / 1024:.0f} KB "
+            f"({'original bytes' if stats['passthrough'] else 're-encoded'}), "
+            f"encode: {stats['encode_ms']:.0f} ms"
+            + (", unchanged since the last upload" if stats.get("reused")
+               else ", from cache" if stats["cached"] else "")
+            + (f", shared a request with {stats['batched'] - 1} other image(s)"
+               if stats.get("batched") else "")
+        )
+        usage = stats.get("usage")
+        if usage:
+            token_note = f"Tokens: {usage['input_tokens']} in / {usage['output_tokens']} out"
+            if stats.get("image_only_tokens"):
+                token_note += f" (image-only input estimate: ~{stats['image_only_tokens']} image tokens)"
+            st.caption(token_note)
+    if result["story"]:
+        st.subheader("Extracted User Stories")
+        st.write(result["story"])
+    else:
+        if result["error"]:
+            st.error(f"Error analyzing image: {result['error']}")
+        st.write("Failed to analyze the image.")
 
-    user_stories = []
-    user_story_count = 0
-    api_code = ""
 
-    if uploaded_file:
-        # Extract images from PDF
-        images = extract_images_from_pdf(uploaded_file.read())
+def render_extracted_image(item):
+    if item.text_only:
+        st.caption("Text-dominant page, analysed from its text layer without an image")
+    else:
+        st.image(item.data, caption=f"Extracted Image", use_column_width=True)
+
+
+def analyze_document_live(pdf_bytes, options, reuse=None):
+    """Extracts and analyses images, rendering each story as soon as it finishes. Returns the per-image results."""
+    (
+        extraction_mode,
+        render_dpi,
+        crop_pages,
+        perceptual_dedup,
+        vision_mode,
+        max_workers,
+        batch_size,
+    ) = options
+
+    # Extraction is lazy, so the first images are analysed while later pages are still being read
+    images = []
+    page_captions = []
+    placeholders = []
+    results = {}
+
+    def show_image(index, item):
+        images.append(item)
+        render_extracted_image(item)
+        page_captions.append(st.empty())
+        # One placeholder per image keeps the page order while results arrive out of order
+        placeholders.append(st.empty())
+
+    for index, analysis_result, stats, error in analyze_images_concurrently(
+        iter_document_images(
+            pdf_bytes,
+            extraction_mode,
+            None if render_dpi == "Auto" else render_dpi,
+            crop_pages,
+            perceptual_dedup,
+            with_text=vision_mode != "Image only",
+        ),
+        max_workers,
+        on_submit=show_image,
+        vision_mode=vision_mode,
+        reuse=reuse,
+        batch_size=batch_size,
+    ):
+        results[index] = {
+            "story": analysis_result,
+            "stats": stats,
+            "error": str(error) if error else None,
+        }
+        with placeholders[index].container():
+            render_image_result(results[index])
+
+    # Page provenance is only complete once extraction has finished
+    for index, item in enumerate(images):
+        pages = ", ".join(str(page) for page in item.pages)
+        page_captions[index].caption(f"Page(s): {pages}")
+
+    return [dict(results[index], item=item) for index, item in enumerate(images)]
+
+
+def generate_story_module(
+    user_story,
+    boiler_plate,
+    programming_language="Python",
+    framework="Flask",
+    additional_instructions="",
+    database="PostgreSQL",
+    orms="SQLAlchemy",
+    yaml_generated="",
+):
+    """Generates only the route handlers for one user story, to be merged into the shared boilerplate."""
+    prompt_story_module = get_prompt("story_module").render(
+        boiler_plate=boiler_plate,
+        user_story=user_story,
+        programming_language=programming_language,
+        framework=framework,
+        database=database,
+        orms=orms,
+        yaml_generated=yaml_generated,
+        additional_instructions=additional_instructions,
+    )
+
+    completion = get_provider("gemini").complete(
+        prompt_story_module,
+        CODE_MODEL,
+        config={"temperature": 0.3, "top_p": 0.9, "top_k": 50},
+        stage="code_parallel",
+    )
+    return strip_code_fences(completion.text), completion.input_tokens
+
+
+def generate_api_code_parallel(
+    user_stories,
+    boiler_plate,
+    programming_language="Python",
+    framework="Flask",
+    additional_instructions="",
+    database="PostgreSQL",
+    orms="SQLAlchemy",
+    yaml_generated="",
+    max_workers=CODEGEN_CONCURRENCY,
+    on_done=None,
+    cancel_event=None,
+    reuse=None,
+):
+    """Generates one module per story concurrently, then merges them into the boilerplate in story order.
+
+    ``reuse`` optionally holds a module per story from an earlier run; stories
+    with one are not generated again. ``on_done(finished, total)`` runs in the
+    calling thread as modules finish; once ``cancel_event`` is set, stories still
+    waiting for a worker are cancelled. The merged code is validated too.
+    Returns (api_code, modules, input_tokens_per_story, errors), where errors maps
+    story indices to messages and "merged" to problems of the merged code.
+    """
+    modules = list(reuse) if reuse else [""] * len(user_stories)
+    input_tokens = [0] * len(user_stories)
+    errors = {}
+    pending = [index for index, module in enumerate(modules) if not module]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run,
+                generate_story_module,
+                story,
+                boiler_plate,
+                programming_language,
+                framework,
+                additional_instructions,
+                database,
+                orms,
+                yaml_generated,
+            ): index
+            for index, story in enumerate(user_stories)
+            if index in pending
+        }
+        for finished, future in enumerate(as_completed(futures), 1):
+            if cancel_event is not None and cancel_event.is_set():
+                for other in futures:
+                    other.cancel()
+            index = futures[future]
+            try:
+                modules[index], input_tokens[index] = future.result()
+            except Exception as e:
+                errors[index] = str(e) or type(e).__name__
+            if on_done:
+                on_done(finished, len(futures))
+
+    # Only the stories whose module fails validation are generated again
+    for index in pending:
+        module = modules[index]
+        if index in errors or (cancel_event is not None and cancel_event.is_set()):
+            continue
+        problems = validation_problems(module, programming_language)
+        for attempt in range(VALIDATION_RETRIES):
+            if not problems:
+                break
+            print(f"Module for story {index + 1} failed validation: {problems}")
+            try:
+                module, input_tokens[index] = generate_story_module(
+                    user_stories[index],
+                    boiler_plate,
+                    programming_language,
+                    framework,
+                    additional_instructions + validation_feedback(problems),
+                    database,
+                    orms,
+                    yaml_generated,
+                )
+            except Exception as e:
+                problems = [str(e)]
+                break
+            problems = validation_problems(module, programming_language)
+        modules[index] = module
+        if problems:
+            errors[index] = "; ".join(problems)
+
+    with tracing.span("code.merge", modules=len(modules)):
+        api_code = merge_story_modules(boiler_plate, modules, programming_language)
+    problems = validation_problems(api_code, programming_language)
+    if problems:
+        errors["merged"] = "; ".join(problems)
+    return api_code, modules, input_tokens, errors
 
-        if images:
 
-            for image in images:  # Iterate through the list of PIL Image objects
-                st.image(image, caption=f"Extracted Image", use_column_width=True)
+def main():
+    st.title("Takim User Story Creator")
+    st.write("Upload a PDF to receive user stories using GPT-4V.")
+    if LLM_BACKEND == "mock":
+        st.sidebar.info("Using the offline mock LLM backend (LLM_BACKEND=mock).")
+    if LLM_RECORD_MODE != "off":
+        st.sidebar.info(f"LLM record/replay mode: {LLM_RECORD_MODE} ({LLM_FIXTURES_DIR})")
+
+    if ADMIN_TOKEN and secrets.compare_digest(
+        st.query_params.get("admin", "").encode(), ADMIN_TOKEN.encode()
+    ):
+        render_admin_view()
+        return
+
+    # A job ID in the URL reattaches to a background job, e.g. after closing the tab
+    job_id = st.query_params.get("job")
+    if job_id:
+        render_background_job(job_id)
+        return
 
-                analysis_result = analyze_image_with_gpt4v(image)
+    uploaded_file = st.file_uploader("Upload PDF", type=["pdf"])
 
-                if analysis_result:
-                    st.subheader("Extracted User Stories")
-                    st.write(analysis_result)
+    if uploaded_file:
+        pdf_bytes = uploaded_file.getvalue()
+        if st.toggle("Run in background", help="Keeps running if you close the tab"):
+            background_job_form(pdf_bytes, uploaded_file.name)
+            return
+        file_key = hashlib.sha256(pdf_bytes).hexdigest()
+        # Stage results live in session state, so a rerun only redoes stages whose inputs changed
+        pipeline = session_pipeline(file_key)
+        # What the last upload of a file with this name produced, for incremental updates
+        manifest = load_manifest(uploaded_file.name, authenticated_user())
 
-                    current_user_story = analysis_result  # Store user story for generate_api_code Function
-                    user_stories.append(current_user_story)
-                    user_story_count += 1
-                
-                else:
-                    st.write("Failed to analyze the image.")
+        # Extract images from PDF
+        extraction_mode = st.selectbox("Extraction mode", EXTRACTION_MODES)
+        render_dpi = st.select_slider(
+            "Render DPI", ["Auto"] + list(RENDER_DPIS), value="Auto"
+        )
+        crop_pages = st.checkbox("Crop rendered pages to drawn region", value=True)
+        perceptual_dedup = st.checkbox("Merge near-identical images", value=False)
+        vision_mode = st.selectbox("Vision input", VISION_MODES)
+        max_workers = st.slider("Concurrent image analyses", 1, 16, VISION_CONCURRENCY)
+        batch_size = st.slider(
+            "Screenshots per vision request",
+            1,
+            8,
+            VISION_BATCH_SIZE,
+            help="Consecutive pages share one request, within the token budget",
+        )
 
+        story_inputs = (
+            file_key,
+            extraction_mode,
+            render_dpi,
+            crop_pages,
+            perceptual_dedup,
+            vision_mode,
+        )
+        image_results = cached_stage(pipeline, "stories", story_inputs)
+        if image_results is None:
+            story_options = make_cache_key(*[repr(value) for value in story_inputs[1:]])
+            known_images = (
+                manifest["images"] if manifest.get("story_options") == story_options else {}
+            )
+            image_results = analyze_document_live(
+                pdf_bytes,
+                story_inputs[1:] + (max_workers, batch_size),
+                reuse=lambda item: known_images.get(manifest_image_key(item, vision_mode)),
+            )
+            # Failed images are not stored, so the next rerun retries them
+            if all(result["story"] for result in image_results):
+                store_stage(pipeline, "stories", story_inputs, image_results)
+                manifest["story_options"] = story_options
+                manifest["images"] = {
+                    manifest_image_key(result["item"], vision_mode): {
+                        "story": result["story"],
+                        "usage": result["stats"].get("usage"),
+                    }
+                    for result in image_results
+                }
+                save_manifest(manifest)
+        else:
+            for result in image_results:
+                render_extracted_image(result["item"])
+                st.caption(f"Page(s): {', '.join(str(page) for page in result['item'].pages)}")
+                render_image_result(result)
+
+        user_stories = [result["story"] for result in image_results if result["story"]]
+
+        if image_results:
+            usage_totals = [
+                result["stats"]["usage"]
+                for result in image_results
+                if result["stats"] and result["stats"].get("usage")
+            ]
+            if usage_totals:
+                st.caption(
+                    f"Vision tokens: {sum(u['input_tokens'] for u in usage_totals)} in / "
+                    f"{sum(u['output_tokens'] for u in usage_totals)} out"
+                )
 
+            cache_stats = vision_cache.stats()
+            st.caption(
+                f"Vision cache (all sessions): {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                f"({cache_stats['hit_rate']:.0%} hit rate)"
+            )
 
+            story_keys = [story_key(story) for story in user_stories]
+            changed, removed = plan_revision(manifest.get("schema_stories", []), story_keys)
+            if manifest.get("schema_stories"):
+                st.info(
+                    f"Revision of {uploaded_file.name}: {len(changed)} new or changed stories, "
+                    f"{removed} removed since the last upload."
+                )
 
             #schema generation
             st.subheader("Generated YAML Schema")
-            combined_user_stories = ""
-            yaml_generated = ""
-
-            for i in range(0, user_story_count):
-                 combined_user_stories += "\n" + user_stories[i]
-                 yaml_generated, token_count = generate_yaml_schema(user_stories[i], combined_user_stories, yaml_generated)
+            schema_inputs = (user_stories,)
+            schema_result = cached_stage(pipeline, "schema", schema_inputs)
+            if schema_result is None:
+                # Only the new or changed stories extend the last version's schema. An edited
+                # page swaps one story for another; only when stories were deleted outright
+                # is the schema rebuilt, so their tables do not linger
+                if manifest.get("schema") and removed <= len(changed):
+                    schema_result = update_yaml_schema(manifest["schema"], user_stories, changed)
+                else:
+                    schema_memo = st.session_state.setdefault("schema_chain", {})
+                    schema_result = build_yaml_schema_chain(user_stories, schema_memo)
+                if schema_result[1] + schema_result[2] == len(user_stories):
+                    store_stage(pipeline, "schema", schema_inputs, schema_result)
+                    manifest["schema"] = schema_result[0]
+                    manifest["schema_stories"] = story_keys
+                    save_manifest(manifest)
+            yaml_generated, reused_steps, generated_steps, schema_tokens = schema_result
+            st.caption(
+                f"Schema steps: {reused_steps} reused from cache, {generated_steps} generated"
+                + (f"; input tokens per call: {schema_tokens}" if schema_tokens else "")
+            )
             st.code(yaml_generated, language="yaml")
-            
-
 
             # Generate boilerplate code based on extracted user stories
             st.subheader("Generated API Code")
-            programming_language = st.selectbox(
-                "Programming Language",
-                ["Python", "JavaScript", "Java", "C#", "Go", "Typescript"],
-            )
-            database = st.selectbox(
-                "Database",
-                ["PostgreSQL", "MySQL", "SQLite", "Microsoft SQL Server","JSON"],
-            )
-            orms = st.selectbox("ORM", ["SQLAlchemy", "Sequelize", "Prisma"])
+            programming_language = st.selectbox("Programming Language", PROGRAMMING_LANGUAGES)
+            database = st.selectbox("Database", DATABASES)
+            orms = st.selectbox("ORM", ORMS)
             framework = st.text_input("Preferred API Framework", "Flask")
             additional_instructions = st.text_area(
                 "Additional Instructions (Optional)", ""
             )
-        
-
-            combined_user_stories = ""
-            combined_answer = ""
-            chat_number = 1
-
-            if st.button("Generate API Code"):
-                boilerplate_code, prompt_boilerplate = generate_boilerplate(
-                    analysis_result,
-                    programming_language,
-                    framework,
-                    additional_instructions,
-                    database,
-                    orms,
-                    yaml_generated
-                )  # should we be pasing this everytime???
-
-                combined_answer += (
-                    "\n\n Prompt "
-                    + str(chat_number)
-                    + ". #### Prompt for API Boilerplate Code Generation:\n\n"
-                    + prompt_boilerplate
-                    + "\n\n Answer "
-                    + str(chat_number)
-                    + ". #### Generated Boilerplate Code from the above prompt:\n\n"
-                    + boilerplate_code
+            codegen_mode = st.radio("Code generation mode", CODEGEN_MODES, horizontal=True)
+
+            code_inputs = (
+                user_stories,
+                yaml_generated,
+                programming_language,
+                framework,
+                additional_instructions,
+                database,
+                orms,
+                codegen_mode,
+            )
+            code_result = cached_stage(pipeline, "api_code", code_inputs)
+            code_options = make_cache_key(*[repr(value) for value in code_inputs[2:]])
+            previous_code = manifest.get("code")
+            # In the serial modes removed stories would leave their routes behind, so those
+            # revisions start over; per-story modules of removed stories are simply left out
+            if previous_code and (
+                previous_code["options"] != code_options
+                or (
+                    codegen_mode != "Parallel per-story"
+                    and plan_revision(previous_code["stories"], story_keys)[1]
                 )
+            ):
+                previous_code = None
 
-                chat_number += 1
-
-                if boilerplate_code:
-                    for i in range(0, user_story_count):
-                        # st.code(boilerplate_code, language=programming_language.lower())
-                        combined_user_stories += "\n" + user_stories[i]
-
-                        if i == 0:
-
-                            api_code, token_count, prompt_api_code = generate_api_code(
-                                current_user_story,
-                                boilerplate_code,
-                                programming_language,
-                                framework,
-                                additional_instructions,
-                                combined_user_stories,
-                                database,
-                                orms,
-                                yaml_generated
-                            )
-
-                            combined_answer += (
-                                "\n\n Prompt "
-                                + str(chat_number)
-                                + ". #### Prompt for API Code Generation:\n\n"
-                                + prompt_api_code
-                                + "\n\n Answer "
-                                + str(chat_number)
-                                + ". #### Generated API Code from the above prompt:\n\n"
-                                + api_code
-                            )
-
-                            chat_number += 1
-
-                            while token_count > 8000:
-                                print("Alert")
-                                remaining_code, token_count = complete_code(combined_answer)
-
-                                api_code += remaining_code
-                                combined_answer += remaining_code
-
-                                print(remaining_code)
-
-                        else:
-                            api_code, token_count, prompt_api_code = generate_api_code(
-                                current_user_story,
-                                api_code,
-                                programming_language,
-                                framework,
-                                additional_instructions,
-                                combined_user_stories,
-                                database,
-                                orms,
-                                yaml_generated
-                            )
-
-                            combined_answer += (
-                                "\n\n Prompt "
-                                + str(chat_number)
-                                + ". #### Prompt for API Code Generation:\n\n"
-                                + prompt_api_code
-                                + "\n\n Answer "
-                                + str(chat_number)
-                                + ". #### Generated API Code from the above prompt:\n\n"
-                                + api_code
-                            )
-
-                            chat_number += 1
-
-                            while token_count > 8000:
-                                print("Alert")
-                                remaining_code, token_count = complete_code(combined_answer)
-
-                                api_code += remaining_code
-                                combined_answer += remaining_code
-
-                                print(remaining_code)
-
-                        # please erase this later
-                        x = "Code for iteration: " + str(i)
-                        st.write(x)
-                        st.code(api_code, language=programming_language.lower())
-
-                    if api_code:
-                        st.write("This is the final code")
-                        st.code(api_code, language=programming_language.lower())
-                else:
+            if code_result is None and st.button("Generate API Code"):
+                code_result = generate_api_code_live(
+                    user_stories, yaml_generated, code_inputs[2:], previous_code
+                )
+                if code_result and code_result["complete"]:
+                    store_stage(pipeline, "api_code", code_inputs, code_result)
+                    manifest["code"] = {
+                        "options": code_options,
+                        "stories": story_keys,
+                        "boilerplate": code_result["boilerplate"],
+                        "modules": dict(zip(story_keys, code_result["modules"])),
+                        "api_code": code_result["api_code"],
+                    }
+                    save_manifest(manifest)
+            elif code_result is not None:
+                for i, (iteration_code, prompt_tokens) in enumerate(code_result["iterations"]):
+                    st.write("Code for iteration: " + str(i))
+                    st.code(iteration_code, language=programming_language.lower())
+                    st.caption(f"Input tokens for this call: {prompt_tokens}")
+                if st.button("Regenerate API Code"):
+                    pipeline.pop("api_code", None)
+                    manifest.pop("code", None)
+                    save_manifest(manifest)
+                    st.rerun()
+
+            if code_result:
+                if code_result["api_code"]:
+                    st.write("This is the final code")
+                    st.code(code_result["api_code"], language=programming_language.lower())
+                elif not code_result["boilerplate"]:
                     st.write("Failed to generate Boilerplate code.")
 
         else:
             st.write("No images were extracted from the PDF.")
 
 
+def generate_api_code_live(user_stories, yaml_generated, options, previous=None):
+    """Generates boilerplate and then the API code, streaming each serial iteration into the page.
+
+    ``previous`` is the manifest entry of the code generated for an earlier version
+    of the document with the same options; its boilerplate and code are kept and
+    only the new or changed stories are generated.
+    """
+    programming_language, framework, additional_instructions, database, orms, codegen_mode = options
+    result = {
+        "boilerplate": "",
+        "iterations": [],
+        "modules": [],
+        "api_code": "",
+        "complete": False,
+    }
+    story_keys = [story_key(story) for story in user_stories]
+    if previous:
+        changed, _ = plan_revision(previous["stories"], story_keys)
+        st.info(f"Updating the code from the last upload for {len(changed)} new or changed stories.")
+        result["boilerplate"] = api_code = previous["boilerplate"]
+    else:
+        changed = list(range(len(user_stories)))
+        boilerplate = generate_boilerplate(
+            "\n".join(user_stories),
+            programming_language,
+            framework,
+            additional_instructions,
+            database,
+            orms,
+            yaml_generated
+        )
+        if not boilerplate or not boilerplate[0]:
+            return result
+        result["boilerplate"] = api_code = boilerplate[0]
+
+    if codegen_mode == "Parallel per-story":
+        # Stories already in the last upload keep their module; a removed story's module is left out
+        reuse = [(previous or {}).get("modules", {}).get(key, "") for key in story_keys]
+        with st.spinner(f"Generating {len(changed)} story modules in parallel..."):
+            merged, modules, input_tokens, errors = generate_api_code_parallel(
+                user_stories,
+                api_code,
+                programming_language,
+                framework,
+                additional_instructions,
+                database,
+                orms,
+                yaml_generated,
+                reuse=reuse,
+            )
+        merge_problems = errors.pop("merged", None)
+        for index, error in sorted(errors.items()):
+            st.error(f"Error generating code for story {index + 1}: {error}")
+        for i in changed:
+            st.write(f"Module for story {i + 1}")
+            st.code(modules[i], language=programming_language.lower())
+            st.caption(f"Input tokens for this call: {input_tokens[i]}")
+            result["iterations"].append((modules[i], input_tokens[i]))
+        if merge_problems:
+            st.error(f"The merged code failed validation: {merge_problems}")
+        result["api_code"] = merged
+        result["modules"] = modules
+        result["complete"] = not errors and not merge_problems
+        return result
+
+    if previous:
+        api_code = previous["api_code"]
+    for i in changed:
+        if previous:
+            story_context = build_story_context(
+                user_stories[:i] + user_stories[i + 1:], user_stories[i]
+            )
+        else:
+            story_context = build_story_context(user_stories[:i], user_stories[i])
+
+        st.write("Code for iteration: " + str(i))
+        live_code = st.empty()
+
+        # Compact spec for resumes instead of the whole conversation
+        spec = (
+            f"{programming_language} API using {framework}, {database} database, ORM: {orms}.\n"
+            f"Current user story:\n{user_stories[i]}"
+        )
+        generated = generate_complete_api_code(
+            spec,
+            user_stories[i],
+            api_code,
+            programming_language,
+            framework,
+            additional_instructions,
+            story_context,
+            database,
+            orms,
+            yaml_generated,
+            on_chunk=lambda text: live_code.code(
+                text, language=programming_language.lower()
+            ),
+            patch=codegen_mode == "Serial diff patches",
+        )
+        if generated is None:
+            return result
+        api_code, token_count, prompt_api_code, prompt_tokens, finish_reason = generated
+
+        live_code.code(api_code, language=programming_language.lower())
+        st.caption(f"Input tokens for this call: {prompt_tokens}")
+        result["iterations"].append((api_code, prompt_tokens))
+
+    result["api_code"] = api_code
+    result["complete"] = True
+    return result
+
+
+def background_job_form(pdf_bytes, name):
+    """Collects every pipeline option up front and submits the PDF as a background job."""
+    with st.form("background_job"):
+        extraction_mode = st.selectbox("Extraction mode", EXTRACTION_MODES)
+        vision_mode = st.selectbox("Vision input", VISION_MODES)
+        vision_workers = st.slider("Concurrent image analyses", 1, 16, VISION_CONCURRENCY)
+        vision_batch = st.slider("Screenshots per vision request", 1, 8, VISION_BATCH_SIZE)
+        programming_language = st.selectbox("Programming Language", PROGRAMMING_LANGUAGES)
+        database = st.selectbox("Database", DATABASES)
+        orms = st.selectbox("ORM", ORMS)
+        framework = st.text_input("Preferred API Framework", "Flask")
+        additional_instructions = st.text_area("Additional Instructions (Optional)", "")
+        codegen_mode = st.radio("Code generation mode", CODEGEN_MODES, horizontal=True)
+        skip_code = st.checkbox("Stop after the schema")
+        submitted = st.form_submit_button("Start background job")
+
+    if submitted:
+        job_id = get_job_manager().submit(
+            pdf_bytes,
+            {
+                "extraction_mode": extraction_mode,
+                "vision_mode": vision_mode,
+                "vision_workers": vision_workers,
+                "vision_batch": vision_batch,
+                "dpi": None,
+                "language": programming_language,
+                "framework": framework,
+                "database": database,
+                "orm": orms,
+                "instructions": additional_instructions,
+                "codegen_mode": codegen_mode,
+                "skip_code": skip_code,
+            },
+            name,
+            user=limits.current_user(),
+        )
+        st.query_params["job"] = job_id
+        st.rerun()
+
+
+def render_background_job(job_id):
+    """Shows progress, controls and results of a background job, refreshing while it runs."""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        st.error(f"No background job with ID {job_id}.")
+        if st.button("Start a new job"):
+            del st.query_params["job"]
+            st.rerun()
+        return
+
+    state = job.snapshot()
+    st.subheader(f"Background job {job_id}")
+    st.caption(f"{state['name']}: {state['status']}. Bookmark this page to come back to it.")
+
+    for stage, label in (
+        ("images", "Images analysed"),
+        ("schema", "Schema steps"),
+        ("code", "Stories coded"),
+    ):
+        progress = state["progress"].get(stage)
+        if progress:
+            st.progress(
+                min(1.0, progress["done"] / max(1, progress["total"])),
+                text=f"{label}: {progress['done']}/{progress['total']}",
+            )
+
+    active = state["status"] in ("queued", "running")
+    if active:
+        if st.button("Cancel job"):
+            manager.cancel(job_id)
+            st.rerun()
+    elif state["status"] != "done":
+        if state["error"]:
+            st.error(state["error"])
+        if st.button("Resume job"):
+            manager.resume(job_id)
+            st.rerun()
+    if st.button("Start a new job"):
+        del st.query_params["job"]
+        st.rerun()
+
+    with st.expander("Log", expanded=False):
+        st.text("\n".join(state["log"]) or "Nothing logged yet.")
+
+    artifacts = job.artifacts()
+    for i, entry in enumerate(artifacts["stories"]):
+        st.write(f"User story {i + 1} (page(s) {', '.join(str(page) for page in entry['pages'])})")
+        st.write(entry["story"])
+    if artifacts["schema"]:
+        st.subheader("Generated YAML Schema")
+        st.code(artifacts["schema"], language="yaml")
+    if artifacts["api_code"]:
+        st.subheader("Generated API Code")
+        st.code(artifacts["api_code"], language=state["options"]["language"].lower())
+
+    if active:
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
+
+def render_trace_panel(trace_id):
+    """Shows where the time went in this session, from the spans recorded so far."""
+    rows = tracing.summarize_trace(trace_id)
+    with st.sidebar.expander("Where the time went", expanded=False):
+        if rows:
+            st.dataframe(rows, hide_index=True)
+        else:
+            st.write("No spans recorded yet.")
+        if tracing.TRACE_FILE:
+            st.caption(f"Trace {trace_id[:8]}… exported to {tracing.TRACE_FILE}")
+
+
+def render_prompt_panel():
+    """Shows the compiled size of every prompt template."""
+    with st.sidebar.expander("Prompt sizes", expanded=False):
+        st.dataframe(prompt_token_counts(), hide_index=True)
+        st.caption("Static prefixes are identical across calls, so provider prompt caching can reuse them.")
+
+
+def authenticated_user():
+    """Returns the user named by the configured proxy header, or "" without one."""
+    return (st.context.headers.get(USER_HEADER) or "") if USER_HEADER else ""
+
+
+def session_user():
+    """Returns who model calls are charged to: the proxy's user header, or this browser session."""
+    return authenticated_user() or st.session_state.setdefault(
+        "user_id", f"session-{secrets.token_hex(4)}"
+    )
+
+
+def render_admin_view():
+    """Shows server-wide throughput, queue depth, cache hit rates and per-user usage."""
+    st.subheader("Admin")
+    st.caption("Figures cover every session in this server process.")
+
+    st.write(f"**Throughput** (last {limits.THROUGHPUT_WINDOW_SECONDS // 60} minutes)")
+    throughput = limits.ledger.throughput()
+    if throughput:
+        st.dataframe(throughput, hide_index=True)
+    else:
+        st.write("No model calls yet.")
+
+    running, queued = get_job_manager().queue_depth()
+    waiting = limits.limiter_queue_depth()
+    st.write("**Queue depth**")
+    st.dataframe(
+        [
+            {"queue": "background jobs running", "depth": running},
+            {"queue": "background jobs queued", "depth": queued},
+        ]
+        + [
+            {"queue": f"{provider} calls waiting for the rate limit", "depth": depth}
+            for provider, depth in sorted(waiting.items())
+        ],
+        hide_index=True,
+    )
+
+    st.write("**Result caches**")
+    st.dataframe(
+        [
+            {"cache": name, **cache.stats()}
+            for name, cache in (("vision", vision_cache), ("schema", schema_cache))
+        ],
+        hide_index=True,
+    )
+
+    st.write(f"**Usage per user** (last {limits.USER_QUOTA_WINDOW_HOURS:g}h)")
+    usage = limits.ledger.usage()
+    if usage:
+        st.dataframe(usage, hide_index=True)
+    else:
+        st.write("No usage recorded.")
+    st.caption(
+        f"Quota per user: {limits.USER_QUOTA_REQUESTS or 'unlimited'} requests, "
+        f"{limits.USER_QUOTA_TOKENS or 'unlimited'} tokens."
+    )
+    if st.button("Refresh"):
+        st.rerun()
+
+
+def run():
+    """Runs main() as one traced rerun of the session, charging its model calls to the session's user."""
+    trace_id = st.session_state.setdefault("trace_id", tracing.new_trace_id())
+    with limits.use_user(session_user()), tracing.use_trace(trace_id):
+        with tracing.span("streamlit.rerun"):
+            main()
+    render_trace_panel(trace_id)
+    render_prompt_panel()
+
+
 if __name__ == "__main__":
-    main()
+    run()
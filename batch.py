@@ -0,0 +1,463 @@
+"""Headless batch runner for the PDF → user stories → schema → API code pipeline.
+
+Examples:
+    python batch.py specs/ --output out/
+    python batch.py --queue jobs/ --output out/ --workers 4
+
+Each PDF gets its own directory under the output folder. Every stage writes its
+artifact there as soon as it finishes, so rerunning the same command after a
+crash picks up where it stopped. checkpoints.json records the inputs each
+artifact was built from (the options that affect its stage and the earlier
+artifacts), so a rerun with different options rebuilds the stages they affect.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+
+import app
+from cache import make_cache_key
+
+# Options each stage's output depends on
+STORY_OPTIONS = ("extraction_mode", "dpi", "vision_mode")
+BOILERPLATE_OPTIONS = ("language", "framework", "database", "orm", "instructions")
+CODE_OPTIONS = BOILERPLATE_OPTIONS + ("codegen_mode",)
+
+LANGUAGE_EXTENSIONS = {
+    "python": "py",
+    "javascript": "js",
+    "typescript": "ts",
+    "java": "java",
+    "c#": "cs",
+    "go": "go",
+}
+
+
+class Cancelled(Exception):
+    """Raised between model calls once a run's cancel event is set."""
+
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise Cancelled()
+
+
+def report(on_progress, stage, done, total):
+    if on_progress:
+        on_progress(stage, done, total)
+
+
+def write_atomic(path, content):
+    """Writes a file via a temp file so a crash never leaves a half-written artifact."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def stage_key(options, names, *inputs):
+    """Hashes the named options and the stage inputs a checkpoint was built from."""
+    chosen = {name: options.get(name) for name in names}
+    return make_cache_key(json.dumps([chosen, *inputs], sort_keys=True))
+
+
+def has_checkpoint(job_dir, name, key):
+    """True when the artifact exists and was built from the same inputs."""
+    checkpoints = read_json(os.path.join(job_dir, "checkpoints.json"), {})
+    return os.path.exists(os.path.join(job_dir, name)) and checkpoints.get(name) == key
+
+
+def mark_checkpoint(job_dir, name, key):
+    path = os.path.join(job_dir, "checkpoints.json")
+    checkpoints = read_json(path, {})
+    checkpoints[name] = key
+    write_atomic(path, json.dumps(checkpoints, indent=2))
+
+
+def job_directory(pdf_path, output_dir):
+    """Returns the artifact directory for a PDF, unique per file content."""
+    with open(pdf_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return os.path.join(output_dir, f"{stem}-{digest}")
+
+
+def run_stories_stage(pdf_bytes, job_dir, options, log, on_progress=None, cancel_event=None):
+    stories_path = os.path.join(job_dir, "stories.json")
+    key = stage_key(options, STORY_OPTIONS, hashlib.sha256(pdf_bytes).hexdigest())
+    stories = read_json(stories_path) if has_checkpoint(job_dir, "stories.json", key) else None
+    if stories is not None:
+        log(f"stories: reusing {len(stories)} from checkpoint")
+        report(on_progress, "images", len(stories), len(stories))
+        return stories
+
+    items = []
+    results = {}
+    for index, story, stats, error in app.analyze_images_concurrently(
+        app.iter_document_images(
+            pdf_bytes,
+            options["extraction_mode"],
+            options["dpi"],
+            True,
+            False,
+            with_text=options["vision_mode"] != "Image only",
+        ),
+        options["vision_workers"],
+        on_submit=lambda index, item: items.append(item),
+        vision_mode=options["vision_mode"],
+        cancel_event=cancel_event,
+        batch_size=options.get("vision_batch", 1),
+    ):
+        if error and not (cancel_event is not None and cancel_event.is_set()):
+            log(f"stories: image {index + 1} failed: {error}")
+        results[index] = (story, stats)
+        report(on_progress, "images", len(results), len(items))
+    check_cancelled(cancel_event)
+
+    stories = []
+    for index, item in enumerate(items):
+        story, stats = results.get(index, (None, None))
+        if story:
+            stories.append(
+                {
+                    "pages": item.pages,
+                    "digest": item.digest,
+                    "story": story,
+                    "usage": (stats or {}).get("usage"),
+                }
+            )
+
+    # Failed images are not checkpointed, so a rerun retries the whole stage
+    # (successful images come back from the vision cache)
+    if len(stories) == len(items):
+        write_atomic(stories_path, json.dumps(stories, indent=2))
+        mark_checkpoint(job_dir, "stories.json", key)
+    log(f"stories: {len(stories)} of {len(items)} images analysed")
+    return stories
+
+
+def run_schema_stage(user_stories, job_dir, log, on_progress=None, cancel_event=None):
+    schema_path = os.path.join(job_dir, "schema.yaml")
+    key = stage_key({}, (), user_stories)
+    if has_checkpoint(job_dir, "schema.yaml", key):
+        log("schema: reusing checkpoint")
+        report(on_progress, "schema", len(user_stories), len(user_stories))
+        with open(schema_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def on_step(done, total):
+        check_cancelled(cancel_event)
+        report(on_progress, "schema", done, total)
+
+    yaml_generated, reused, generated, _ = app.build_yaml_schema_chain(
+        user_stories, on_step=on_step
+    )
+    if reused + generated < len(user_stories):
+        raise RuntimeError("schema generation failed")
+    write_atomic(schema_path, yaml_generated)
+    mark_checkpoint(job_dir, "schema.yaml", key)
+    log(f"schema: {reused} steps reused, {generated} generated")
+    return yaml_generated
+
+
+def run_code_stage(
+    user_stories, yaml_generated, job_dir, options, log, on_progress=None, cancel_event=None
+):
+    ext = LANGUAGE_EXTENSIONS.get(options["language"].lower(), "txt")
+    code_path = os.path.join(job_dir, f"api_code.{ext}")
+    code_key = stage_key(options, CODE_OPTIONS, user_stories, yaml_generated)
+    if has_checkpoint(job_dir, os.path.basename(code_path), code_key):
+        log("code: reusing checkpoint")
+        report(on_progress, "code", len(user_stories), len(user_stories))
+        return
+    # Code for another language from an earlier run would be shown as this run's result
+    for stale_path in glob.glob(os.path.join(job_dir, "api_code.*")):
+        os.remove(stale_path)
+
+    boilerplate_path = os.path.join(job_dir, "boilerplate.txt")
+    boilerplate_key = stage_key(options, BOILERPLATE_OPTIONS, user_stories, yaml_generated)
+    if has_checkpoint(job_dir, "boilerplate.txt", boilerplate_key):
+        with open(boilerplate_path, "r", encoding="utf-8") as f:
+            boilerplate_code = f.read()
+    else:
+        result = app.generate_boilerplate(
+            "\n".join(user_stories),
+            options["language"],
+            options["framework"],
+            options["instructions"],
+            options["database"],
+            options["orm"],
+            yaml_generated,
+        )
+        if not result or not result[0]:
+            raise RuntimeError("boilerplate generation failed")
+        boilerplate_code = result[0]
+        write_atomic(boilerplate_path, boilerplate_code)
+        mark_checkpoint(job_dir, "boilerplate.txt", boilerplate_key)
+    check_cancelled(cancel_event)
+
+    if options.get("codegen_mode") == "Parallel per-story":
+        api_code, _, _, errors = app.generate_api_code_parallel(
+            user_stories,
+            boilerplate_code,
+            options["language"],
+            options["framework"],
+            options["instructions"],
+            options["database"],
+            options["orm"],
+            yaml_generated,
+            on_done=lambda done, total: report(on_progress, "code", done, total),
+            cancel_event=cancel_event,
+        )
+        check_cancelled(cancel_event)
+        merge_problems = errors.pop("merged", None)
+        if errors:
+            raise RuntimeError(f"code generation failed for stories {sorted(errors)}")
+        if merge_problems:
+            raise RuntimeError(f"merged code failed validation: {merge_problems}")
+        write_atomic(code_path, api_code)
+        mark_checkpoint(job_dir, os.path.basename(code_path), code_key)
+        log(f"code: {len(user_stories)} story modules generated and merged")
+        return
+
+    # Per-story progress so a crash mid-chain resumes at the next story
+    progress_path = os.path.join(job_dir, "code_progress.json")
+    progress = read_json(progress_path)
+    if not progress or progress.get("key") != code_key:
+        progress = {"done": 0, "api_code": boilerplate_code}
+    api_code = progress["api_code"]
+    report(on_progress, "code", progress["done"], len(user_stories))
+
+    for i in range(progress["done"], len(user_stories)):
+        check_cancelled(cancel_event)
+        spec = (
+            f"{options['language']} API using {options['framework']}, "
+            f"{options['database']} database, ORM: {options['orm']}.\n"
+            f"Current user story:\n{user_stories[i]}"
+        )
+        result = app.generate_complete_api_code(
+            spec,
+            user_stories[i],
+            api_code,
+            options["language"],
+            options["framework"],
+            options["instructions"],
+            app.build_story_context(user_stories[:i], user_stories[i]),
+            options["database"],
+            options["orm"],
+            yaml_generated,
+            # Aborts the stream at the next chunk instead of waiting for the full answer
+            on_chunk=(lambda text: check_cancelled(cancel_event)) if cancel_event else None,
+            patch=options.get("codegen_mode") == "Serial diff patches",
+        )
+        check_cancelled(cancel_event)
+        if result is None:
+            raise RuntimeError(f"code generation failed at story {i + 1}")
+        api_code = result[0]
+        write_atomic(
+            progress_path, json.dumps({"key": code_key, "done": i + 1, "api_code": api_code})
+        )
+        report(on_progress, "code", i + 1, len(user_stories))
+        log(f"code: story {i + 1}/{len(user_stories)} done")
+
+    write_atomic(code_path, api_code)
+    mark_checkpoint(job_dir, os.path.basename(code_path), code_key)
+    os.remove(progress_path)
+
+
+def run_pipeline(pdf_bytes, job_dir, options, log, on_progress=None, cancel_event=None):
+    """Runs every stage for one PDF into job_dir, skipping stages that already have artifacts.
+
+    ``on_progress(stage, done, total)`` reports images, schema steps and coded
+    stories; setting ``cancel_event`` raises Cancelled at the next model call.
+    """
+    stories = run_stories_stage(pdf_bytes, job_dir, options, log, on_progress, cancel_event)
+    user_stories = [entry["story"] for entry in stories]
+    if not user_stories:
+        raise RuntimeError("no user stories were extracted")
+
+    yaml_generated = run_schema_stage(user_stories, job_dir, log, on_progress, cancel_event)
+    if not options["skip_code"]:
+        run_code_stage(
+            user_stories, yaml_generated, job_dir, options, log, on_progress, cancel_event
+        )
+
+
+def process_pdf(pdf_path, output_dir, options):
+    """Runs one PDF through every stage, skipping stages that already have artifacts."""
+    job_dir = job_directory(pdf_path, output_dir)
+    os.makedirs(job_dir, exist_ok=True)
+    name = os.path.basename(pdf_path)
+    start = time.perf_counter()
+
+    def log(message):
+        print(f"[{name}] {message}", flush=True)
+
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    run_pipeline(pdf_bytes, job_dir, options, log)
+
+    log(f"finished in {time.perf_counter() - start:.1f}s -> {job_dir}")
+    return job_dir
+
+
+def _worker(args):
+    pdf_path, output_dir, options = args
+    try:
+        return pdf_path, process_pdf(pdf_path, output_dir, options), None
+    except Exception:
+        return pdf_path, None, traceback.format_exc()
+
+
+def collect_pdfs(inputs):
+    pdfs = []
+    for path in inputs:
+        if os.path.isdir(path):
+            pdfs += sorted(glob.glob(os.path.join(path, "*.pdf")))
+        else:
+            pdfs.append(path)
+    return pdfs
+
+
+def run_directory(inputs, output_dir, options, workers):
+    """Processes a fixed set of PDFs on a process pool. Returns the number of failures."""
+    pdfs = collect_pdfs(inputs)
+    failures = 0
+    with Pool(processes=max(1, workers)) as pool:
+        for pdf_path, job_dir, error in pool.imap_unordered(
+            _worker, [(pdf, output_dir, options) for pdf in pdfs]
+        ):
+            if error:
+                failures += 1
+                print(f"[{os.path.basename(pdf_path)}] failed:\n{error}", file=sys.stderr)
+    print(f"{len(pdfs) - failures} of {len(pdfs)} PDFs processed")
+    return failures
+
+
+def claim_jobs(queue_dir, limit):
+    """Moves up to limit PDFs from the queue into processing/ and returns their new paths."""
+    processing_dir = os.path.join(queue_dir, "processing")
+    claimed = []
+    for pdf_path in sorted(glob.glob(os.path.join(queue_dir, "*.pdf")))[:limit]:
+        target = os.path.join(processing_dir, os.path.basename(pdf_path))
+        try:
+            os.rename(pdf_path, target)  # Atomic on one filesystem
+        except OSError:
+            continue
+        claimed.append(target)
+    return claimed
+
+
+def run_queue(queue_dir, output_dir, options, workers, poll_seconds=2.0, once=False):
+    """Watches a queue directory and processes PDFs dropped into it.
+
+    Jobs move through processing/ to done/ or failed/. Anything left in
+    processing/ by a crash is put back on the queue at startup.
+    """
+    for sub in ("processing", "done", "failed"):
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+    for leftover in glob.glob(os.path.join(queue_dir, "processing", "*.pdf")):
+        os.rename(leftover, os.path.join(queue_dir, os.path.basename(leftover)))
+
+    with Pool(processes=max(1, workers)) as pool:
+        pending = {}
+        while True:
+            for pdf_path in claim_jobs(queue_dir, workers - len(pending)):
+                pending[pdf_path] = pool.apply_async(_worker, ((pdf_path, output_dir, options),))
+
+            for pdf_path, result in list(pending.items()):
+                if not result.ready():
+                    continue
+                del pending[pdf_path]
+                _, _, error = result.get()
+                target = "failed" if error else "done"
+                if error:
+                    print(f"[{os.path.basename(pdf_path)}] failed:\n{error}", file=sys.stderr)
+                shutil.move(pdf_path, os.path.join(queue_dir, target, os.path.basename(pdf_path)))
+
+            if once and not pending and not glob.glob(os.path.join(queue_dir, "*.pdf")):
+                return
+            time.sleep(poll_seconds)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="*", help="PDF files or directories of PDFs")
+    parser.add_argument("--queue", help="Directory to watch for PDFs instead of fixed inputs")
+    parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+    parser.add_argument("--output", default="output", help="Directory for artifacts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Worker processes")
+    parser.add_argument(
+        "--vision-workers",
+        type=int,
+        default=app.VISION_CONCURRENCY,
+        help="Concurrent image analyses per PDF",
+    )
+    parser.add_argument(
+        "--vision-batch",
+        type=int,
+        default=app.VISION_BATCH_SIZE,
+        help="Screenshots from consecutive pages per vision request",
+    )
+    parser.add_argument(
+        "--extraction-mode", default="Auto", choices=["Auto", "Embedded images", "Render pages"]
+    )
+    parser.add_argument("--vision-mode", default="Image only", choices=app.VISION_MODES)
+    parser.add_argument("--dpi", type=int, default=None, help="Render DPI (default: lowest readable)")
+    parser.add_argument("--language", default="Python")
+    parser.add_argument("--framework", default="Flask")
+    parser.add_argument("--database", default="PostgreSQL")
+    parser.add_argument("--orm", default="SQLAlchemy")
+    parser.add_argument("--instructions", default="", help="Additional instructions for code generation")
+    parser.add_argument("--codegen-mode", default="Serial chain", choices=app.CODEGEN_MODES)
+    parser.add_argument("--skip-code", action="store_true", help="Stop after the schema stage")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.queue:
+        parser.error("give PDF inputs or --queue")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {
+        "extraction_mode": args.extraction_mode,
+        "vision_mode": args.vision_mode,
+        "vision_workers": args.vision_workers,
+        "vision_batch": args.vision_batch,
+        "dpi": args.dpi,
+        "language": args.language,
+        "framework": args.framework,
+        "database": args.database,
+        "orm": args.orm,
+        "instructions": args.instructions,
+        "codegen_mode": args.codegen_mode,
+        "skip_code": args.skip_code,
+    }
+    os.makedirs(args.output, exist_ok=True)
+
+    if args.queue:
+        run_queue(args.queue, args.output, options, args.workers, once=args.once)
+        return 0
+    return 1 if run_directory(args.inputs, args.output, options, args.workers) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""End-to-end pipeline benchmark against the local mock LLM backend.
+
+Examples:
+    python benchmark.py --synthetic 3 --output bench.json
+    python benchmark.py specs/ --latency-scale 0.2 --baseline bench.json
+
+Runs every PDF through the same stages as batch.py (stories, schema,
+boilerplate + code). It reports wall time per stage, per-call p50/p95
+latency, tokens, upload bytes and estimated cost per call stage, and the
+compiled size of every prompt template, as JSON.
+With --baseline, the exit status is non-zero when wall time or tokens regress
+beyond --tolerance.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_synthetic_pdf(path, pages=6, seed=0):
+    """Writes a PDF of form-like pages: an embedded screenshot per page, a repeated logo and vector widgets."""
+    import io
+
+    import fitz
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+
+    def png(width, height, shapes):
+        image = Image.new("RGB", (width, height), (250, 250, 250))
+        draw = ImageDraw.Draw(image)
+        for _ in range(shapes):
+            x0, y0 = rng.randrange(width - 60), rng.randrange(height - 30)
+            x1, y1 = x0 + rng.randint(40, 200), y0 + rng.randint(20, 40)
+            draw.rectangle([x0, y0, x1, y1], outline=(60, 60, 60), width=2)
+            label = rng.choice(["Name", "Email", "Save", "Cancel", "Search"])
+            draw.text((x0 + 6, y0 + 6), label, fill=(0, 0, 0))
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return buffered.getvalue()
+
+    logo = png(160, 60, 2)
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_image(fitz.Rect(36, 20, 196, 80), stream=logo)  # Same logo on every page
+        page.insert_image(fitz.Rect(36, 100, 576, 460), stream=png(1280, 860, 12))
+        for row in range(4):
+            rect = fitz.Rect(36, 480 + row * 50, 300, 510 + row * 50)
+            page.draw_rect(rect, color=(0.3, 0.3, 0.3))
+            page.insert_text((rect.x0 + 4, rect.y0 + 19), f"Field {page_num}.{row}", fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+class CallCollector:
+    """Thread-safe call listener that keeps every CallRecord."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+def summarize(records, wall_times, estimate_cost):
+    """Aggregates call records by stage, plus wall time per pipeline stage."""
+    stages = {}
+    for record in records:
+        stages.setdefault(record.stage or "unlabelled", []).append(record)
+
+    summary = {
+        "pipeline_wall_s": {name: round(value, 4) for name, value in wall_times.items()},
+        "calls": {},
+    }
+    for stage, stage_records in sorted(stages.items()):
+        latencies = [record.latency for record in stage_records]
+        input_tokens = sum(record.input_tokens for record in stage_records)
+        output_tokens = sum(record.output_tokens for record in stage_records)
+        summary["calls"][stage] = {
+            "count": len(stage_records),
+            "errors": sum(1 for record in stage_records if record.error),
+            "p50_s": round(percentile(latencies, 0.5), 4),
+            "p95_s": round(percentile(latencies, 0.95), 4),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "upload_bytes": sum(record.upload_bytes for record in stage_records),
+            "cost_usd": round(
+                sum(
+                    estimate_cost(record.model, record.input_tokens, record.output_tokens)
+                    for record in stage_records
+                ),
+                6,
+            ),
+        }
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """Returns human-readable regressions of results against a baseline result file."""
+    regressions = []
+
+    def check(label, current, previous):
+        if previous and current > previous * (1 + tolerance):
+            regressions.append(f"{label}: {previous} -> {current}")
+
+    check("total wall_s", results["total"]["wall_s"], baseline["total"]["wall_s"])
+    for name, stats in results.get("prompts", {}).items():
+        previous = baseline.get("prompts", {}).get(name)
+        if previous:
+            check(f"prompt {name}.template_tokens", stats["template_tokens"], previous["template_tokens"])
+    for stage, stats in results["calls"].items():
+        previous = baseline.get("calls", {}).get(stage)
+        if not previous:
+            continue
+        for key in ("count", "input_tokens", "output_tokens", "upload_bytes", "p95_s"):
+            check(f"{stage}.{key}", stats[key], previous[key])
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="*", help="PDF files or directories of PDFs")
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help="Also generate this many sample PDFs"
+    )
+    parser.add_argument("--pages", type=int, default=6, help="Pages per synthetic PDF")
+    parser.add_argument(
+        "--latency-scale", type=float, default=1.0, help="Mock latency multiplier (0 = no sleeps)"
+    )
+    parser.add_argument("--vision-workers", type=int, default=4)
+    parser.add_argument("--vision-batch", type=int, default=1, help="Screenshots per vision request")
+    parser.add_argument("--vision-mode", default="Image only")
+    parser.add_argument("--extraction-mode", default="Auto")
+    parser.add_argument(
+        "--codegen-mode",
+        default="Serial chain",
+        choices=["Serial chain", "Serial diff patches", "Parallel per-story"],
+    )
+    parser.add_argument("--skip-code", action="store_true")
+    parser.add_argument(
+        "--warm-cache", action="store_true", help="Keep the normal CACHE_DIR instead of a fresh one"
+    )
+    parser.add_argument("--output", help="Write JSON results here (default: stdout)")
+    parser.add_argument("--baseline", help="Previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.synthetic:
+        parser.error("give PDF inputs or --synthetic N")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+
+    # The backend and cache location are read at import time
+    os.environ["LLM_BACKEND"] = "mock"
+    os.environ["MOCK_LATENCY_SCALE"] = str(args.latency_scale)
+    if not args.warm_cache:
+        os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+
+    import batch
+    import prompts
+    import providers
+
+    pdfs = batch.collect_pdfs(args.inputs)
+    for i in range(args.synthetic):
+        path = os.path.join(workdir, f"synthetic-{i}.pdf")
+        make_synthetic_pdf(path, args.pages, seed=i)
+        pdfs.append(path)
+
+    options = {
+        "extraction_mode": args.extraction_mode,
+        "vision_mode": args.vision_mode,
+        "vision_workers": args.vision_workers,
+        "vision_batch": args.vision_batch,
+        "dpi": None,
+        "language": "Python",
+        "framework": "Flask",
+        "database": "PostgreSQL",
+        "orm": "SQLAlchemy",
+        "instructions": "",
+        "codegen_mode": args.codegen_mode,
+        "skip_code": args.skip_code,
+    }
+
+    collector = CallCollector()
+    providers.add_call_listener(collector)
+    wall_times = {"stories": 0.0, "schema": 0.0, "code": 0.0}
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    start = time.perf_counter()
+    for pdf_path in pdfs:
+        job_dir = os.path.join(workdir, "output", os.path.basename(pdf_path))
+        os.makedirs(job_dir, exist_ok=True)
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+
+        stage_start = time.perf_counter()
+        stories = batch.run_stories_stage(pdf_bytes, job_dir, options, log)
+        wall_times["stories"] += time.perf_counter() - stage_start
+        user_stories = [entry["story"] for entry in stories]
+
+        stage_start = time.perf_counter()
+        yaml_generated = batch.run_schema_stage(user_stories, job_dir, log)
+        wall_times["schema"] += time.perf_counter() - stage_start
+
+        if not args.skip_code:
+            stage_start = time.perf_counter()
+            batch.run_code_stage(user_stories, yaml_generated, job_dir, options, log)
+            wall_times["code"] += time.perf_counter() - stage_start
+    total = time.perf_counter() - start
+    providers.remove_call_listener(collector)
+
+    results = summarize(collector.records, wall_times, providers.estimate_cost)
+    results["total"] = {
+        "wall_s": round(total, 4),
+        "pdfs": len(pdfs),
+        "calls": len(collector.records),
+        "cost_usd": round(sum(stats["cost_usd"] for stats in results["calls"].values()), 6),
+    }
+    results["prompts"] = {row["prompt"]: row for row in prompts.prompt_token_counts()}
+    results["config"] = {
+        key: value for key, value in vars(args).items() if key not in ("output", "baseline")
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def make_cache_key(*parts):
+    """Builds a content-addressed key from bytes/str parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # Length prefix so ("ab", "c") and ("a", "bc") never collide
+        digest.update(str(len(part)).encode() + b":")
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Size-bounded on-disk JSON cache with LRU eviction and hit/miss counters."""
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}  # key -> [lock, holders]
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, count_miss=True):
+        """Returns the cached value for key, or None on a miss.
+
+        ``count_miss=False`` is for re-checks of a key already counted as a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)["value"]
+        except (OSError, ValueError, KeyError):
+            if count_miss:
+                with self._lock:
+                    self.misses += 1
+            return None
+
+        # Touch the entry so eviction treats it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    @contextmanager
+    def lock(self, key):
+        """Holds a per-key lock, so callers computing the same entry at once wait for the first."""
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def set(self, key, value):
+        """Stores a JSON-serialisable value and evicts old entries if needed."""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"value": value, "created": time.time()}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            # Oldest access time first
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+    def stats(self):
+        """Returns hit/miss counters and the hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def shared_cache(directory, max_bytes=50 * 1024 * 1024):
+    """Returns the process-wide DiskCache for directory, so every session shares its entries and counters."""
+    with _shared_caches_lock:
+        if directory not in _shared_caches:
+            _shared_caches[directory] = DiskCache(directory, max_bytes)
+        return _shared_caches[directory]
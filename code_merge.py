@@ -0,0 +1,204 @@
+"""Deterministic merging of per-story route modules into the shared boilerplate."""
+
+import io
+import re
+import tokenize
+
+FENCE_RE = re.compile(r"^\s*```[\w#+.-]*\s*\n(.*?)\n\s*```\s*$", re.S)
+
+# Lines that pull in dependencies, per language family
+IMPORT_RE = re.compile(
+    r"^(import\s|from\s+\S+\s+import\s|using\s|package\s|#include\s"
+    r"|(const|let|var)\s+.+=\s*require\(|import\(|require\s)"
+)
+
+# Where generated route code must go before (the app's entry point)
+ENTRY_POINT_RE = re.compile(
+    r"^(if\s+__name__\s*==\s*['\"]__main__['\"]|app\.listen\(|func\s+main\(\)"
+    r"|public\s+static\s+void\s+main\(|app\.Run\(|module\.exports)"
+)
+
+PY_SYMBOL_RE = re.compile(r"^(?:async\s+)?(def|class)\s+(\w+)")
+
+
+def strip_code_fences(text):
+    """Returns the code inside a single markdown fence, or the text unchanged."""
+    if not text:
+        return text
+    match = FENCE_RE.match(text.strip() + "\n")
+    if match:
+        return match.group(1)
+    # Several fenced blocks: keep only their contents
+    blocks = re.findall(r"```[\w#+.-]*\s*\n(.*?)\n\s*```", text, re.S)
+    return "\n\n".join(blocks) if blocks else text
+
+
+def bracket_depth(line):
+    """Net number of brackets a line opens; import lines hold no bracket characters in strings."""
+    return sum(line.count(c) for c in "([{") - sum(line.count(c) for c in ")]}")
+
+
+def split_imports(code):
+    """Splits code into (import statements, remaining lines).
+
+    An import that spans lines (open brackets or a trailing backslash) is kept
+    together as one multi-line statement.
+    """
+    imports, body = [], []
+    statement = None
+    depth = 0
+    for line in code.splitlines():
+        if statement is None:
+            if not IMPORT_RE.match(line):
+                body.append(line)
+                continue
+            statement, depth = [line], bracket_depth(line)
+        else:
+            statement.append(line)
+            depth += bracket_depth(line)
+        if depth <= 0 and not line.rstrip().endswith("\\"):
+            imports.append("\n".join(statement))
+            statement = None
+    if statement is not None:
+        imports.append("\n".join(statement))
+    return imports, body
+
+
+def import_key(statement):
+    """Normalises an import statement so layout differences do not defeat de-duplication."""
+    return " ".join(statement.replace("(", " ( ").replace(")", " ) ").replace(",", " , ").split())
+
+
+def top_level_blocks(lines):
+    """Groups Python lines into top-level blocks; decorators stay with the def/class they decorate."""
+    blocks = []
+    current = []
+    pending_decorators = False
+    for line in lines:
+        starts_block = line and not line[0].isspace() and not line.startswith(")")
+        if starts_block and current and not pending_decorators:
+            blocks.append(current)
+            current = []
+        current.append(line)
+        if starts_block:
+            pending_decorators = line.startswith("@")
+    if current:
+        blocks.append(current)
+    return blocks
+
+
+def block_symbol(block):
+    """Returns ('def'|'class', name) for a Python block, or None."""
+    for line in block:
+        if not line or line[0].isspace() or line.startswith(")"):
+            continue  # Continuation of a multi-line decorator
+        match = PY_SYMBOL_RE.match(line)
+        if match:
+            return match.groups()
+        if not line.startswith("@"):
+            return None
+    return None
+
+
+def block_text(block):
+    return "\n".join(line.rstrip() for line in block).strip("\n")
+
+
+def rename_symbol(blocks, name, new_name):
+    """Renames a def/class and every bare reference to it within one module's blocks.
+
+    Only name tokens change, not attributes or text inside strings. If the module
+    cannot be tokenized, only the definition line is renamed.
+    """
+    lines = [line for block in blocks for line in block]
+    positions = []
+    try:
+        previous = None
+        for token in tokenize.generate_tokens(io.StringIO("\n".join(lines) + "\n").readline):
+            if token.type == tokenize.NAME and token.string == name and previous != ".":
+                positions.append(token.start)
+            if token.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.COMMENT):
+                previous = token.string
+    except (tokenize.TokenError, SyntaxError):
+        definition = re.compile(rf"^((?:async\s+)?(?:def|class)\s+){re.escape(name)}\b")
+        positions = [
+            (row, definition.match(line).end(1))
+            for row, line in enumerate(lines, 1)
+            if definition.match(line)
+        ]
+    for row, col in sorted(positions, reverse=True):
+        line = lines[row - 1]
+        lines[row - 1] = line[:col] + new_name + line[col + len(name):]
+
+    renamed = []
+    for block in blocks:
+        renamed.append(lines[:len(block)])
+        lines = lines[len(block):]
+    return renamed
+
+
+def merge_story_modules(boilerplate, modules, language="Python"):
+    """Merges per-story modules into the boilerplate in story order.
+
+    Imports (including multi-line ones) are hoisted and de-duplicated, and module
+    bodies are inserted before the entry point (or appended). For Python, a
+    function or class identical to one defined earlier (boilerplate first, then
+    earlier stories) is dropped; a different one with the same name is renamed
+    with a ``_story<n>`` suffix, together with its references in that module.
+    The result depends only on the inputs.
+    """
+    base_imports, base_body = split_imports(strip_code_fences(boilerplate))
+    imports = list(base_imports)
+    seen_imports = {import_key(statement) for statement in base_imports}
+
+    python = language.lower() == "python"
+    seen_symbols = {}  # (kind, name) -> block text
+    if python:
+        for block in top_level_blocks(base_body):
+            symbol = block_symbol(block)
+            if symbol:
+                seen_symbols[symbol] = block_text(block)
+
+    sections = []
+    for index, module in enumerate(modules):
+        if not module:
+            continue
+        module_imports, module_body = split_imports(strip_code_fences(module))
+        for statement in module_imports:
+            if import_key(statement) not in seen_imports:
+                seen_imports.add(import_key(statement))
+                imports.append(statement)
+
+        kept = []
+        if python:
+            blocks = top_level_blocks(module_body)
+            for block in list(blocks):
+                symbol = block_symbol(block)
+                if symbol in seen_symbols and seen_symbols[symbol] != block_text(block):
+                    kind, name = symbol
+                    new_name = f"{name}_story{index + 1}"
+                    print(f"Story {index + 1} redefines {kind} {name}, renamed to {new_name}")
+                    blocks = rename_symbol(blocks, name, new_name)
+            for block in blocks:
+                symbol = block_symbol(block)
+                if symbol and symbol in seen_symbols:
+                    continue  # Identical to an earlier definition
+                if symbol:
+                    seen_symbols[symbol] = block_text(block)
+                kept += block
+        else:
+            kept = module_body
+
+        body = "\n".join(kept).strip("\n")
+        if body:
+            comment = "#" if python else "//"
+            sections.append(f"{comment} --- User story {index + 1} ---\n{body}")
+
+    entry = next(
+        (i for i, line in enumerate(base_body) if ENTRY_POINT_RE.match(line)), len(base_body)
+    )
+    head = "\n".join(base_body[:entry]).strip("\n")
+    tail = "\n".join(base_body[entry:]).strip("\n")
+
+    parts = ["\n".join(imports).strip("\n"), head] + sections + [tail]
+    return "\n\n\n".join(part for part in parts if part) + "\n"
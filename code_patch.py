@@ -0,0 +1,79 @@
+"""SEARCH/REPLACE patches against generated code, applied and checked locally."""
+
+import re
+
+from code_merge import ENTRY_POINT_RE
+from validation import ValidationError, validate_python
+
+PATCH_BLOCK_RE = re.compile(
+    r"^<{5,9} SEARCH[ \t]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} REPLACE[ \t]*$", re.M | re.S
+)
+
+
+class PatchError(ValueError):
+    """Raised when a patch cannot be parsed, applied or validated."""
+
+
+def parse_patch(text):
+    """Returns the (search, replace) pairs of a SEARCH/REPLACE patch."""
+    blocks = PATCH_BLOCK_RE.findall(text or "")
+    if not blocks:
+        raise PatchError("no SEARCH/REPLACE blocks in the response")
+    return blocks
+
+
+def insert_before_entry_point(code, addition):
+    """Inserts code before the app's entry point (or at the end)."""
+    lines = code.splitlines()
+    entry = next((i for i, line in enumerate(lines) if ENTRY_POINT_RE.match(line)), None)
+    if entry is None:
+        # Keep additions inside a trailing code fence
+        entry = len(lines)
+        while entry and lines[entry - 1].strip() in ("", "```"):
+            entry -= 1
+    return "\n".join(lines[:entry] + addition.rstrip("\n").splitlines() + [""] + lines[entry:]) + "\n"
+
+
+def _replace_stripped(code, search, replace):
+    """Replaces the one run of lines equal to search ignoring surrounding whitespace, or returns None."""
+    lines = code.splitlines()
+    wanted = [line.strip() for line in search.strip("\n").splitlines()]
+    matches = [
+        i
+        for i in range(len(lines) - len(wanted) + 1)
+        if [line.strip() for line in lines[i:i + len(wanted)]] == wanted
+    ]
+    if len(matches) != 1:
+        return None
+    i = matches[0]
+    return "\n".join(lines[:i] + replace.rstrip("\n").splitlines() + lines[i + len(wanted):]) + "\n"
+
+
+def apply_patch(code, blocks):
+    """Applies (search, replace) blocks in order. An empty search adds code before the entry point."""
+    for number, (search, replace) in enumerate(blocks, 1):
+        if not search.strip():
+            code = insert_before_entry_point(code, replace)
+            continue
+        count = code.count(search)
+        if count == 1:
+            code = code.replace(search, replace, 1)
+            continue
+        if count > 1:
+            raise PatchError(f"block {number}: search text matches {count} places")
+        patched = _replace_stripped(code, search, replace)
+        if patched is None:
+            raise PatchError(f"block {number}: search text not found")
+        code = patched
+    return code
+
+
+def validate_code(code, language):
+    """Raises PatchError when patched code is clearly broken (Python is byte-compiled)."""
+    if not code.strip():
+        raise PatchError("patched code is empty")
+    if language.lower() == "python":
+        try:
+            validate_python(code)
+        except ValidationError as e:
+            raise PatchError(f"patched {e}")
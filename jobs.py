@@ -0,0 +1,218 @@
+"""Background pipeline jobs shared by every Streamlit session in the process.
+
+Jobs run on one bounded thread pool (JOB_WORKERS), so many users on one server
+queue up instead of each holding a script thread for minutes. Each job has a
+directory under JOBS_DIR with the uploaded PDF, the stage artifacts written by
+batch.run_pipeline and job.json (status, per-stage progress, recent log lines).
+A session reattaches by job ID after a reload; a job cut off by a restart is
+marked interrupted and can be resumed from its checkpoints.
+"""
+
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import limits
+import tracing
+
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join("output", "jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Log lines kept in job.json for the UI
+JOB_LOG_LINES = 50
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class Job:
+    """One pipeline run. State changes are written to job.json as they happen."""
+
+    def __init__(self, job_id, directory, state):
+        self.job_id = job_id
+        self.directory = directory
+        self.state = state
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def pdf_path(self):
+        return os.path.join(self.directory, "input.pdf")
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def update(self, **changes):
+        with self._lock:
+            self.state.update(changes)
+            self._save()
+
+    def _save(self):
+        path = os.path.join(self.directory, "job.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def progress(self, stage, done, total):
+        with self._lock:
+            self.state["progress"][stage] = {"done": done, "total": total}
+            self._save()
+
+    def log(self, message):
+        print(f"[job {self.job_id}] {message}", flush=True)
+        with self._lock:
+            self.state["log"] = (self.state["log"] + [message])[-JOB_LOG_LINES:]
+            self._save()
+
+    def artifacts(self):
+        """Returns whatever the stages have written so far: stories, schema and API code."""
+
+        def read(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return f.read()
+            except OSError:
+                return None
+
+        stories = read(os.path.join(self.directory, "stories.json"))
+        code_paths = [
+            path
+            for path in glob.glob(os.path.join(self.directory, "api_code.*"))
+            if not path.endswith(".tmp")
+        ]
+        return {
+            "stories": json.loads(stories) if stories else [],
+            "schema": read(os.path.join(self.directory, "schema.yaml")),
+            "api_code": read(code_paths[0]) if code_paths else None,
+        }
+
+
+class JobManager:
+    """Submits, tracks and cancels jobs on a bounded worker pool."""
+
+    def __init__(self, directory=JOBS_DIR, max_workers=JOB_WORKERS):
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="pipeline-job"
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, pdf_bytes, options, name="", user=limits.ANONYMOUS):
+        """Stores the PDF and queues a run of every stage, charged to user's quota. Returns the job ID."""
+        job_id = secrets.token_hex(8)
+        directory = os.path.join(self.directory, job_id)
+        os.makedirs(directory, exist_ok=True)
+        job = Job(
+            job_id,
+            directory,
+            {
+                "job_id": job_id,
+                "name": name,
+                "user": user,
+                "options": options,
+                "status": "queued",
+                "progress": {},
+                "log": [],
+                "error": None,
+                "trace_id": None,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+            },
+        )
+        with open(job.pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+        job.update()
+        with self._lock:
+            self._jobs[job_id] = job
+        self.executor.submit(self._run, job)
+        return job_id
+
+    def get(self, job_id):
+        """Returns the job, loading it from disk if this process did not start it, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job
+            directory = os.path.join(self.directory, os.path.basename(job_id))
+            try:
+                with open(os.path.join(directory, "job.json"), "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                return None
+            job = Job(job_id, directory, state)
+            if state["status"] in ACTIVE_STATUSES:
+                # Nothing in this process is running it, so the previous server stopped mid-run
+                job.update(status="interrupted")
+            self._jobs[job_id] = job
+            return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and job.state["status"] in ACTIVE_STATUSES:
+            job.cancel_event.set()
+            job.log("cancel requested")
+
+    def resume(self, job_id):
+        """Re-queues a finished, failed, cancelled or interrupted job; finished stages are skipped."""
+        job = self.get(job_id)
+        if job is None or job.state["status"] in ACTIVE_STATUSES:
+            return
+        job.cancel_event = threading.Event()
+        job.update(status="queued", error=None, finished=None)
+        self.executor.submit(self._run, job)
+
+    def queue_depth(self):
+        """Returns (running, queued) job counts."""
+        with self._lock:
+            statuses = [job.state["status"] for job in self._jobs.values()]
+        return statuses.count("running"), statuses.count("queued")
+
+    def _run(self, job):
+        import batch  # batch imports app, which imports this module
+
+        if job.cancel_event.is_set():
+            job.update(status="cancelled", finished=time.time())
+            return
+        trace_id = tracing.new_trace_id()
+        job.update(status="running", started=time.time(), trace_id=trace_id)
+        try:
+            with open(job.pdf_path, "rb") as f:
+                pdf_bytes = f.read()
+            with limits.use_user(job.state.get("user")), tracing.use_trace(trace_id):
+                with tracing.span("job.run", job_id=job.job_id):
+                    batch.run_pipeline(
+                        pdf_bytes,
+                        job.directory,
+                        job.state["options"],
+                        job.log,
+                        on_progress=job.progress,
+                        cancel_event=job.cancel_event,
+                    )
+            job.update(status="done", finished=time.time())
+        except Exception as e:
+            if job.cancel_event.is_set():
+                job.log("cancelled")
+                job.update(status="cancelled", finished=time.time())
+            else:
+                job.log(f"failed: {e}")
+                job.update(status="failed", error=traceback.format_exc(), finished=time.time())
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """Returns the process-wide JobManager, shared by every session."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,179 @@
+"""Process-wide request limits shared by every Streamlit session.
+
+Each provider gets one token bucket (requests per minute with a small burst),
+so concurrent sessions queue for the provider instead of tripping its rate
+limit together. Every call is also admitted against the calling user's quota:
+requests and tokens over a sliding window, with the user taken from a context
+variable that worker threads inherit through ``contextvars.copy_context``.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# 0 disables the limit
+USER_QUOTA_REQUESTS = int(os.getenv("USER_QUOTA_REQUESTS", "0"))
+USER_QUOTA_TOKENS = int(os.getenv("USER_QUOTA_TOKENS", "0"))
+USER_QUOTA_WINDOW_HOURS = float(os.getenv("USER_QUOTA_WINDOW_HOURS", "24"))
+# Span of recent calls the throughput figures are averaged over
+THROUGHPUT_WINDOW_SECONDS = 300
+
+ANONYMOUS = "anonymous"
+
+_current_user = contextvars.ContextVar("current_user", default=ANONYMOUS)
+
+
+class QuotaExceededError(RuntimeError):
+    """Raised before a model call when the user has used up their quota."""
+
+
+@contextmanager
+def use_user(user):
+    """Attributes model calls made inside the block to user."""
+    token = _current_user.set(user or ANONYMOUS)
+    try:
+        yield
+    finally:
+        _current_user.reset(token)
+
+
+def current_user():
+    return _current_user.get()
+
+
+class TokenBucket:
+    """Allows ``per_minute`` requests on average with bursts of up to ``burst``. acquire() blocks."""
+
+    def __init__(self, per_minute, burst=1):
+        self.rate = per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping until one is available. Returns the seconds waited."""
+        if self.rate <= 0:
+            return 0.0
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - start
+                    delay = (1 - self.tokens) / self.rate
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def rate_limiter(name, per_minute=0, burst=1):
+    """Returns the process-wide bucket for a provider, created with these settings on first use."""
+    with _buckets_lock:
+        if name not in _buckets:
+            _buckets[name] = TokenBucket(per_minute, burst)
+        return _buckets[name]
+
+
+def limiter_queue_depth():
+    """Returns {provider: calls waiting for a token}."""
+    with _buckets_lock:
+        return {name: bucket.waiting for name, bucket in _buckets.items()}
+
+
+class UsageLedger:
+    """Recent model calls per user, for quotas and throughput figures."""
+
+    def __init__(self, max_requests=0, max_tokens=0, window_hours=24):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.window = window_hours * 3600
+        self._calls = defaultdict(deque)  # user -> [time, provider, tokens]
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        horizon = now - max(self.window, THROUGHPUT_WINDOW_SECONDS)
+        for user in list(self._calls):
+            calls = self._calls[user]
+            while calls and calls[0][0] < horizon:
+                calls.popleft()
+            if not calls:
+                del self._calls[user]
+
+    def _usage(self, user, now):
+        calls = [call for call in self._calls.get(user, ()) if call[0] >= now - self.window]
+        return len(calls), sum(call[2] for call in calls)
+
+    def admit(self, user, provider):
+        """Counts a call against user's quota or raises QuotaExceededError. Returns the call entry."""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            requests, tokens = self._usage(user, now)
+            if self.max_requests and requests >= self.max_requests:
+                raise QuotaExceededError(
+                    f"Request quota reached for {user}: {requests} of {self.max_requests} "
+                    f"in the last {self.window / 3600:g}h"
+                )
+            if self.max_tokens and tokens >= self.max_tokens:
+                raise QuotaExceededError(
+                    f"Token quota reached for {user}: {tokens} of {self.max_tokens} "
+                    f"in the last {self.window / 3600:g}h"
+                )
+            entry = [now, provider, 0]
+            self._calls[user].append(entry)
+            return entry
+
+    def record(self, entry, tokens):
+        """Adds the tokens a finished call used to its entry."""
+        with self._lock:
+            entry[2] = tokens
+
+    def usage(self):
+        """Returns one row per user with requests and tokens in the quota window."""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            rows = []
+            for user in sorted(self._calls):
+                requests, tokens = self._usage(user, now)
+                rows.append({"user": user, "requests": requests, "tokens": tokens})
+        return rows
+
+    def throughput(self):
+        """Returns one row per provider with requests and tokens per minute over the recent window."""
+        now = time.time()
+        totals = defaultdict(lambda: [0, 0])
+        with self._lock:
+            for calls in self._calls.values():
+                for started, provider, tokens in calls:
+                    if started >= now - THROUGHPUT_WINDOW_SECONDS:
+                        totals[provider][0] += 1
+                        totals[provider][1] += tokens
+        minutes = THROUGHPUT_WINDOW_SECONDS / 60
+        return [
+            {
+                "provider": provider,
+                "requests_per_minute": round(requests / minutes, 2),
+                "tokens_per_minute": round(tokens / minutes),
+            }
+            for provider, (requests, tokens) in sorted(totals.items())
+        ]
+
+
+ledger = UsageLedger(USER_QUOTA_REQUESTS, USER_QUOTA_TOKENS, USER_QUOTA_WINDOW_HOURS)
@@ -0,0 +1,70 @@
+"""Per-document manifests for incremental re-processing of revised PDFs.
+
+A manifest is keyed by the uploaded file name, plus its owner when users are
+authenticated (two users' ``spec.pdf`` are then different documents), and
+records what the last version of that document produced: the story derived
+from each image (by content hash), the schema and the stories it was built
+from, and the generated code with its per-story modules. When a revision is uploaded, unchanged images
+reuse their story and only the new or changed stories go through the schema
+and code steps.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from cache import make_cache_key
+
+MANIFEST_DIR = os.getenv(
+    "MANIFEST_DIR", os.path.join(os.getenv("CACHE_DIR", ".cache"), "manifests")
+)
+
+
+def manifest_path(document_name, owner="", directory=None):
+    """Returns the manifest file for a document; the hash keeps similar names and owners apart.
+
+    ``owner`` is empty when users are not authenticated, so the document name alone is the key.
+    """
+    stem = re.sub(r"[^\w.-]+", "_", os.path.splitext(os.path.basename(document_name))[0])
+    key = f"{owner}\0{document_name}" if owner else document_name
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(directory or MANIFEST_DIR, f"{stem[:60]}-{digest}.json")
+
+
+def load_manifest(document_name, owner="", directory=None):
+    """Returns the stored manifest for a user's document, or an empty one."""
+    try:
+        with open(manifest_path(document_name, owner, directory), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"document": document_name, "owner": owner, "images": {}}
+
+
+def save_manifest(manifest, directory=None):
+    path = manifest_path(manifest["document"], manifest.get("owner", ""), directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save manifest for {manifest['document']}: {e}")
+
+
+def story_key(story):
+    return make_cache_key(story)
+
+
+def plan_revision(previous_keys, current_keys):
+    """Compares story keys of the last and the new version of a document.
+
+    Returns (changed, removed): indices into current_keys of stories that are new
+    or changed, and the number of earlier stories no longer present.
+    """
+    previous = set(previous_keys)
+    current = set(current_keys)
+    changed = [i for i, key in enumerate(current_keys) if key not in previous]
+    return changed, len(previous - current)
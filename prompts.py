@@ -0,0 +1,417 @@
+"""Versioned prompt templates for every model call.
+
+Templates are written readably below and compiled once at import: indentation is
+removed, trailing spaces and runs of blank lines are collapsed and repeated
+instruction lines are dropped (code fences are left as they are). Each template
+has a static prefix holding the instructions and a body holding the
+{placeholders}, so the prefix is byte-identical across calls and provider-side
+prompt caching can match it. A template's version is derived from its compiled
+text, so any edit changes the keys of results cached from it.
+"""
+
+import hashlib
+import re
+import textwrap
+from dataclasses import dataclass
+
+from story_context import estimate_tokens
+
+FENCE_LINE_RE = re.compile(r"^\s*```")
+
+
+def compact(text):
+    """Normalizes template whitespace and drops repeated lines outside code fences."""
+    lines = []
+    seen = set()
+    in_fence = False
+    for line in textwrap.dedent(text).strip("\n").splitlines():
+        line = line.rstrip()
+        if FENCE_LINE_RE.match(line):
+            in_fence = not in_fence
+        elif not in_fence and line:
+            if line.strip() in seen:
+                continue
+            seen.add(line.strip())
+        if not line and lines and not lines[-1]:
+            continue
+        lines.append(line)
+    return "\n".join(lines).strip("\n") + "\n"
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """A compiled prompt: a static prefix followed by a format-string body."""
+
+    name: str
+    prefix: str
+    body: str
+    raw_tokens: int
+
+    @property
+    def version(self):
+        return hashlib.sha256((self.prefix + self.body).encode("utf-8")).hexdigest()[:12]
+
+    def render(self, **values):
+        return self.prefix + self.body.format(**values)
+
+
+PROMPTS = {}
+
+
+def register(name, prefix, body=""):
+    """Compiles a template once and adds it to the registry."""
+    template = PromptTemplate(
+        name,
+        compact(prefix),
+        compact(body) if body else "",
+        estimate_tokens(prefix + body),
+    )
+    PROMPTS[name] = template
+    return template
+
+
+def get_prompt(name):
+    return PROMPTS[name]
+
+
+def prompt_token_counts():
+    """Returns one row per template: static prefix, template and uncompiled sizes in tokens."""
+    return [
+        {
+            "prompt": template.name,
+            "version": template.version,
+            "prefix_tokens": estimate_tokens(template.prefix) if template.prefix else 0,
+            "template_tokens": estimate_tokens(template.prefix + template.body),
+            "uncompiled_tokens": template.raw_tokens,
+        }
+        for template in PROMPTS.values()
+    ]
+
+
+register(
+    "vision",
+    """
+    Identify any fields, buttons and text in the screenshots and create user stories with acceptance criteria in BDD/Gherkin format from them.
+
+    Display results as follows:
+
+    #### **User Story:**
+    As a [role], I want [feature] so that [benefit].
+
+    #### **Acceptance Criteria:**
+    - **Feature:** A brief description of the functionality
+      - **Scenario:** Provide a detailed name for each scenario.
+      - **Given:** Outline the preconditions necessary for the scenario.
+      - **When:** Specify the actions taken by the user.
+      - **Then:** State the expected results after the actions.
+
+    Requirements:
+    - DO NOT WRITE ETC, WRITE IN DETAIL AND WRITE FULL SENTENCES
+    - Also ensure all text fields and buttons and text are mentioned in the user stories and acceptance criteria.
+    - Do not use short forms or reduce the number of examples; include every option explicitly.
+    - Write out all details completely without omitting any examples or categories; include ALL of them.
+    - Write out all details completely without omitting any examples or categories; include ALL of them.
+    """,
+)
+
+register(
+    "vision_text_layer",
+    "",
+    """
+    Text layer extracted from the PDF (text @ [x0, y0, x1, y1] in points). Use it for exact labels instead of reading them from the image:
+    {text_layer}
+    """,
+)
+
+register(
+    "vision_batch",
+    "",
+    """
+    You are given {count} screenshots, in order. Treat each screenshot separately and write its user stories under a heading line `### Image k`, where k is the screenshot's position (1 to {count}). Write nothing before the first heading.
+    """,
+)
+
+register(
+    "vision_batch_text_layer",
+    "",
+    """
+    Text layer of Image {k} (text @ [x0, y0, x1, y1] in points):
+    {text_layer}
+    """,
+)
+
+register(
+    "boilerplate",
+    """
+    ## Prompt for API Boilerplate Code Generation
+
+    **Instructions:**
+    You are an AI code generation assistant. Your task is to generate *only* the boilerplate code of the API based on the provided user stories, programming language, API framework, database, ORM (if any), the schema in YAML format and additional instructions. Do *not* include any explanatory text, comments outside of the code itself, or any other information besides the code. Ensure the generated code is well-structured, readable, and follows best practices for the chosen language and framework. Include necessary error handling and consider security implications where applicable. Assume all necessary libraries and dependencies are pre-installed. Focus on providing a functional boilerplate for an API implementation.
+    If the provided framework has issues or is not provided, then choose the best framework for the given programming language.
+
+    **Important Instructions:**
+    - Further ensure that the API includes CORS policy with allow-all origins. And further include any other security considerations.
+    - Further ensure there are GET requests for each respective POST request.
+
+    **Output:**
+    Provide *only* the boilerplate code with the stated database defined and API definitions.
+    """,
+    """
+    **Input:**
+    1. **User Stories:**
+    {user_stories}
+
+    2. **Programming Language:** {programming_language}
+    3. **API Framework:** {framework}
+    4. **Database:** {database}
+    5. **ORM:** {orm_context}
+
+    6. **YAML Schema:**
+    {yaml_generated}
+
+    7. **Additional Instructions:**
+    {additional_instructions}
+    """,
+)
+
+register(
+    "code",
+    """
+    ## Prompt for API Code Generation (Code-Only Output)
+
+    **Instructions:**
+    You are an AI code generation assistant. Your task is to generate the API code given the boilerplate, detailed user story and acceptance criteria, programming language, API framework, and additional instructions. Consider the previous context of user stories and code when generating the API for this current user story. Do *not* include any explanatory text, comments outside of the code itself, or any other information besides the code. Ensure the generated code is well-structured, readable, and follows best practices for the chosen language and framework. Include necessary error handling and consider security implications where applicable. Assume all necessary libraries and dependencies are pre-installed. Focus on providing a functional API implementation.
+    Replace any comments that say "Simulate the logic by yourself", "Add the logic by yourself", etc. with the correct implementation based on the user stories and best practices.
+    If the code is using raw dictionaries and manual data retrieval/storage, replace them with queries through the given ORM while following the given database's best practices.
+    If any API is not implemented in the boilerplate, implement it in the final code given the user story and Gherkin.
+    If the provided framework has issues or is not provided, then choose the best framework for the given programming language.
+
+    **Important Instructions:**
+    - Avoid reusing similar logic, instead use functions or reusable components where necessary.
+    - Ensure the code remains within 800 lines, avoiding unnecessary verbosity while maintaining readability and completeness.
+    - Further ensure that the API includes CORS policy with allow-all origins. And further include any other security considerations.
+    - Further ensure there are GET requests for each respective POST request.
+    - Ensure the outputs are not mock-up dictionaries but actual data from the database.
+
+    **Expected Output:**
+    1. Only the complete and functional API code in the specified programming language and framework, including necessary imports, function definitions, routing, middleware (if applicable), and any other required code.
+    2. The given code with placeholder comments replaced by actual logic.
+    3. ORM-based data handling instead of dictionary-based storage.
+    4. Proper adherence to the framework's best practices.
+    """,
+    """
+    {context}
+    **Input:**
+    1. **Previously produced code that you need to build upon** (it may contain placeholder comments and logic that need to be replaced with the implementation):
+    {boiler_plate}
+
+    2. **User Story and Gherkin:**
+    {user_story}
+
+    3. **Programming Language:** {programming_language}
+    4. **API Framework:** {framework}
+    5. **Database:** {database}
+    6. **ORM:** {orms}
+
+    7. **YAML Schema:**
+    {yaml_generated}
+
+    8. **Additional Instructions:**
+    {additional_instructions}
+    """,
+)
+
+register(
+    "code_patch",
+    """
+    ## Prompt for Incremental API Code Changes (Patch Output)
+
+    **Instructions:**
+    You are an AI code generation assistant. Extend the current API code below so it also implements the new user story and acceptance criteria. Output *only* the changes, as SEARCH/REPLACE blocks:
+
+    <<<<<<< SEARCH
+    exact lines copied from the current code
+    =======
+    the lines that replace them
+    >>>>>>> REPLACE
+
+    - The SEARCH part must match the current code exactly, including indentation, and must be unique in it; include a few neighbouring lines when needed.
+    - Leave the SEARCH part empty to add new code (imports, models, routes) before the application's entry point.
+    - Keep blocks small and never repeat unchanged code beyond the lines needed to locate a change.
+    - Output nothing but the blocks: no explanations and no code fences around them.
+    - Replace placeholder comments and dictionary-based storage you touch with real queries through the given ORM, following the given database's best practices.
+    - Further ensure there are GET requests for each respective POST request.
+    """,
+    """
+    {context}
+    **Current code:**
+    {boiler_plate}
+
+    **New User Story and Gherkin:**
+    {user_story}
+
+    **Programming Language:** {programming_language}
+    **API Framework:** {framework}
+    **Database:** {database}
+    **ORM:** {orms}
+
+    **YAML Schema:**
+    {yaml_generated}
+
+    **Additional Instructions:**
+    {additional_instructions}
+    """,
+)
+
+register(
+    "validation_feedback",
+    "",
+    """
+
+    **Your previous answer was rejected by validation:**
+    {problems}
+    Fix these problems and answer again in the same format.
+    """,
+)
+
+register(
+    "code_context",
+    "",
+    """
+    **Previous Image User Stories and Acceptance Criterias that were used to build the code provided below:**
+    {combined_user_stories}
+    """,
+)
+
+register(
+    "code_continuation",
+    """
+    You are an AI completing unfinished code. Below is a short specification and the end of the incomplete code. Your task is to continue the code from where it was left off without repeating any previous content.
+
+    Instructions:
+    1. Do not repeat any part of the already generated code.
+    2. Do not add explanations or comments, only output the remaining unfinished code.
+    3. Maintain the original style and structure of the code.
+    """,
+    """
+    Specification:
+    {spec}
+
+    End of the Incomplete Code:
+    {tail}
+
+    Now, continue the code from where it left off. Output only the remaining unfinished code and nothing else.
+    """,
+)
+
+register(
+    "story_module",
+    """
+    ## Prompt for Per-Story API Module Generation (Code-Only Output)
+
+    **Instructions:**
+    You are an AI code generation assistant. The boilerplate below already sets up the application, database connection, models and middleware. Write *only* the additional code needed to implement the user story below: route handlers, request validation and any helper functions or models the boilerplate is missing.
+    - Do *not* repeat the boilerplate, do not create a new application object and do not add a server start / entry point.
+    - Use the names already defined in the boilerplate (application object, database session, models).
+    - Include the imports your code needs at the top.
+    - Ensure there are GET requests for each respective POST request.
+    - Use queries through the given ORM following the given database's best practices; no mock-up dictionaries.
+    - Do *not* include any explanatory text.
+    """,
+    """
+    **Boilerplate (read-only):**
+    {boiler_plate}
+
+    **User Story and Gherkin:**
+    {user_story}
+
+    **Programming Language:** {programming_language}
+    **API Framework:** {framework}
+    **Database:** {database}
+    **ORM:** {orms}
+
+    **YAML Schema:**
+    {yaml_generated}
+
+    **Additional Instructions:**
+    {additional_instructions}
+    """,
+)
+
+register(
+    "schema_system",
+    """
+    You are an expert database architect, specializing in creating practical, efficient relational schemas.
+    Your priority is to ensure the schema is normalized and clean, but avoid overcomplication, especially with unnecessary junction tables.
+    """,
+)
+
+register(
+    "schema",
+    """
+    ## Prompt for Schema Code Generation (YAML)
+
+    You are an expert database schema designer. Your task is to generate a well-structured, normalized (3NF) relational database schema in YAML format based on provided user stories and their corresponding acceptance criteria. The previously generated YAML schema is included for reference, so edit it and add to it. Focus on creating a schema that minimizes redundancy, ensures data integrity, and avoids excessive columns per table.
+
+    **Instructions:**
+    1. **Analyze User Story and Acceptance Criteria:** Carefully analyze the provided user story and its acceptance criteria to identify all entities, attributes, and relationships necessary to fulfill the requirements.
+    2. **Identify Entities and Attributes:** Extract distinct entities and their relevant attributes from the user story.
+    3. **Determine Relationships:** Identify the relationships between entities (one-to-one, one-to-many, many-to-many).
+    4. **Normalize to 3NF:** Stick to 3NF, **but don't overdo it**. If a table gets too fragmented or introduces too many unnecessary joins, intelligently **merge tables**.
+    5. **Minimize Columns:** Strive to create tables with a reasonable number of columns.
+    6. **Define Primary and Foreign Keys:** Clearly define primary keys for each table and establish foreign key relationships to enforce referential integrity. Write a column's foreign key as `foreign_key: table.column` (for example `foreign_key: users.id`), naming a table and column defined in the schema.
+    7. **Data Types:** Select appropriate data types for each attribute based on the nature of the data.
+    8. **Output Format:** Provide the schema in YAML format, clearly defining tables, columns, data types, primary keys, and foreign keys.
+    9. **Assume Best Practices:** Adhere to database design best practices, including proper naming conventions and data type selection.
+    10. **Focus on Data Structure:** Focus solely on the schema structure, without considering specific database engine syntax or implementation details unless absolutely necessary to define a datatype.
+    11. **Handle Many-to-Many:** Use junction tables **only** when the many-to-many relationship is complex or needs additional data. For simple relationships, prioritize **direct foreign keys**.
+
+    **Expected Output:**
+    Deliver only the schema in clean YAML format (no explanations), defining tables, columns, data types, primary keys, foreign keys and relationships.
+    Use this example only as a reference for the structure of the YAML file; do not copy it:
+    ```yaml
+    tables:
+      users:
+        columns:
+          - id:
+              type: Integer
+              primary_key: true
+          - name:
+              type: String(100)
+          - email:
+              type: String(150)
+              unique: true
+        relationships:
+          - tasks:
+              type: one_to_many
+              related_table: tasks
+              foreign_key: assigned_to
+      tasks:
+        columns:
+          - id:
+              type: Integer
+              primary_key: true
+          - assigned_to:
+              type: Integer
+              foreign_key: users.id
+    ```
+    """,
+    """
+    {context}
+    **Input:**
+    1. **Previously produced schema that you need to build upon** (it may be incomplete and need updating for the new user story):
+    {previous_yaml_schema}
+
+    2. **User Story and Gherkin:**
+    {user_story}
+    """,
+)
+
+register(
+    "schema_context",
+    "",
+    """
+    **Previous Image User Stories and Acceptance Criterias that were used to generate the current schema:**
+    {combined_user_stories}
+    """,
+)
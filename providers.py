@@ -0,0 +1,710 @@
+"""LLM provider layer: long-lived clients, timeouts/retries and an offline mock backend.
+
+Every model call in the app goes through ``get_provider(name)``. Setting
+``LLM_BACKEND=mock`` swaps every provider for a deterministic local stand-in
+with simulated latency, so the pipeline and benchmarks run without network access.
+Provider SDKs are imported and their clients built on a provider's first use,
+so starting the app (or running the mock) never loads them.
+
+``LLM_RECORD_MODE=record`` saves every response (text, token usage, latency and
+stream timing) under ``LLM_FIXTURES_DIR``; ``replay`` serves them back with their
+original timing, and ``auto`` replays when a fixture exists and records otherwise.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import limits
+import tracing
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "live")  # live or mock
+MOCK_LATENCY_SCALE = float(os.getenv("MOCK_LATENCY_SCALE", "1.0"))
+LLM_RECORD_MODE = os.getenv("LLM_RECORD_MODE", "off")  # off, record, replay or auto
+LLM_FIXTURES_DIR = os.getenv("LLM_FIXTURES_DIR", os.path.join("fixtures", "llm"))
+# 1.0 replays the recorded latency, 0 returns fixtures immediately
+REPLAY_LATENCY_SCALE = float(os.getenv("REPLAY_LATENCY_SCALE", "1.0"))
+
+# Per-provider settings; timeouts are per request in seconds. The request rate is
+# shared by every session in the process (0 leaves it unlimited).
+PROVIDER_SETTINGS = {
+    "openai": {
+        "timeout": float(os.getenv("OPENAI_TIMEOUT", "120")),
+        "max_retries": int(os.getenv("OPENAI_MAX_RETRIES", "5")),
+        "requests_per_minute": float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "0")),
+        "burst": int(os.getenv("OPENAI_BURST", "5")),
+    },
+    "gemini": {
+        "timeout": float(os.getenv("GEMINI_TIMEOUT", "300")),
+        "max_retries": int(os.getenv("GEMINI_MAX_RETRIES", "5")),
+        "requests_per_minute": float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "0")),
+        "burst": int(os.getenv("GEMINI_BURST", "5")),
+    },
+}
+
+
+# USD per million tokens (input, output), used for cost estimates only
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+}
+
+
+@dataclass
+class CallRecord:
+    """One finished model call, as passed to call listeners."""
+
+    provider: str
+    model: str
+    stage: str
+    latency: float
+    input_tokens: int
+    output_tokens: int
+    upload_bytes: int
+    finish_reason: str
+    error: str = ""
+
+
+_call_listeners = []
+
+
+def add_call_listener(listener):
+    """Registers listener(CallRecord), called after every model call in this process."""
+    _call_listeners.append(listener)
+
+
+def remove_call_listener(listener):
+    if listener in _call_listeners:
+        _call_listeners.remove(listener)
+
+
+def estimate_cost(model, input_tokens, output_tokens):
+    """Estimated USD cost of a call, or 0.0 for unknown models."""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+@dataclass
+class Completion:
+    """Normalised result of one model call."""
+
+    text: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    finish_reason: str = "STOP"  # STOP or MAX_TOKENS
+    latency: float = 0.0
+    upload_bytes: int = 0
+
+
+def call_with_retries(fn, is_retryable, max_retries, base_delay=1.0):
+    """Calls fn, retrying retryable errors with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+
+            # Prefer the server's own hint when it sends one
+            retry_after = None
+            response = getattr(e, "response", None)
+            if response is not None and hasattr(response, "headers"):
+                retry_after = response.headers.get("retry-after")
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = base_delay * (2**attempt) + random.uniform(0, base_delay)
+
+            print(f"{type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+
+
+def images_upload_bytes(images):
+    return sum(len(image["data"]) for image in images or ())
+
+
+class LLMProvider:
+    """Base provider. Subclasses implement _complete() and optionally _stream().
+
+    ``stage`` labels the call (vision, schema, code, ...) for listeners such as
+    the benchmark and tracing.
+    """
+
+    name = "base"
+
+    def complete(self, prompt, model, images=None, max_tokens=None, config=None, stage=""):
+        """Runs one request. ``prompt`` is a string or a list of strings; ``images`` a list of {"mime", "data"}."""
+        return self._observe(
+            lambda: self._complete(prompt, model, images, max_tokens, config),
+            model,
+            stage,
+            images,
+        )
+
+    def stream(
+        self, prompt, model, images=None, max_tokens=None, config=None, on_chunk=None, stage=""
+    ):
+        """Streams a request, calling on_chunk(text_so_far) as text arrives."""
+        return self._observe(
+            lambda: self._stream(prompt, model, images, max_tokens, config, on_chunk),
+            model,
+            stage,
+            images,
+        )
+
+    def _complete(self, prompt, model, images, max_tokens, config):
+        raise NotImplementedError
+
+    def _stream(self, prompt, model, images, max_tokens, config, on_chunk):
+        completion = self._complete(prompt, model, images, max_tokens, config)
+        if on_chunk and completion.text:
+            on_chunk(completion.text)
+        return completion
+
+    def _observe(self, call, model, stage, images):
+        # Quotas are checked before waiting for the provider's shared rate limit
+        usage = limits.ledger.admit(limits.current_user(), self.name)
+        settings = PROVIDER_SETTINGS.get(self.name, {})
+        waited = limits.rate_limiter(
+            self.name, settings.get("requests_per_minute", 0), settings.get("burst", 1)
+        ).acquire()
+        start = time.perf_counter()
+        with tracing.span(
+            f"llm.{stage or 'call'}", provider=self.name, model=model
+        ) as call_span:
+            if waited:
+                call_span.set(rate_limit_wait=round(waited, 3))
+            try:
+                completion = call()
+            except Exception as e:
+                self._notify(
+                    CallRecord(
+                        self.name, model, stage, time.perf_counter() - start, 0, 0,
+                        images_upload_bytes(images), "ERROR", str(e),
+                    )
+                )
+                raise
+            call_span.set(
+                input_tokens=completion.input_tokens,
+                output_tokens=completion.output_tokens,
+                upload_bytes=completion.upload_bytes,
+                finish_reason=completion.finish_reason,
+            )
+        limits.ledger.record(usage, completion.input_tokens + completion.output_tokens)
+        self._notify(
+            CallRecord(
+                self.name,
+                model,
+                stage,
+                completion.latency,
+                completion.input_tokens,
+                completion.output_tokens,
+                completion.upload_bytes,
+                completion.finish_reason,
+            )
+        )
+        return completion
+
+    @staticmethod
+    def _notify(record):
+        for listener in list(_call_listeners):
+            try:
+                listener(record)
+            except Exception as e:
+                print(f"Call listener failed: {e}")
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, api_key=None, timeout=120.0, max_retries=5):
+        import openai  # Deferred like every SDK, so startup and mock runs never load it
+
+        # Retries are handled here so they are uniform across providers
+        self.client = openai.OpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"), timeout=timeout, max_retries=0
+        )
+        self.max_retries = max_retries
+
+    @staticmethod
+    def is_retryable(e):
+        import openai
+
+        return isinstance(
+            e,
+            (
+                openai.RateLimitError,
+                openai.APITimeoutError,
+                openai.APIConnectionError,
+                openai.InternalServerError,
+            ),
+        )
+
+    def _complete(self, prompt, model, images, max_tokens, config):
+        text = prompt if isinstance(prompt, str) else "\n".join(prompt)
+        content = [{"type": "text", "text": text}]
+        for image in images or ():
+            content.append(
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{image['mime']};base64,{base64.b64encode(image['data']).decode()}"
+                    },
+                }
+            )
+
+        start = time.perf_counter()
+        response = call_with_retries(
+            lambda: self.client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": content if images else text}],
+                max_tokens=max_tokens,
+                **(config or {}),
+            ),
+            self.is_retryable,
+            self.max_retries,
+        )
+        choice = response.choices[0]
+        return Completion(
+            text=choice.message.content or "",
+            input_tokens=response.usage.prompt_tokens if response.usage else 0,
+            output_tokens=response.usage.completion_tokens if response.usage else 0,
+            finish_reason="MAX_TOKENS" if choice.finish_reason == "length" else "STOP",
+            latency=time.perf_counter() - start,
+            upload_bytes=images_upload_bytes(images),
+        )
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, api_key=None, timeout=300.0, max_retries=5):
+        from google import genai
+
+        self.client = genai.Client(
+            api_key=api_key or os.getenv("GOOGLE_API_KEY"),
+            http_options={"timeout": int(timeout * 1000)},  # milliseconds
+        )
+        self.max_retries = max_retries
+
+    @staticmethod
+    def is_retryable(e):
+        from google.genai import errors as genai_errors
+
+        return isinstance(e, genai_errors.APIError) and e.code in (429, 500, 503)
+
+    @staticmethod
+    def _config(max_tokens, config):
+        config = dict(config or {})
+        if max_tokens:
+            config["max_output_tokens"] = max_tokens
+        return config or None
+
+    @staticmethod
+    def _finish_reason(reason):
+        reason = getattr(reason, "value", reason)
+        return "MAX_TOKENS" if reason == "MAX_TOKENS" else "STOP"
+
+    def _complete(self, prompt, model, images, max_tokens, config):
+        start = time.perf_counter()
+        response = call_with_retries(
+            lambda: self.client.models.generate_content(
+                model=model, contents=prompt, config=self._config(max_tokens, config)
+            ),
+            self.is_retryable,
+            self.max_retries,
+        )
+        usage = response.usage_metadata
+        return Completion(
+            text=response.text or "",
+            input_tokens=(usage.prompt_token_count or 0) if usage else 0,
+            output_tokens=(usage.candidates_token_count or 0) if usage else 0,
+            finish_reason=self._finish_reason(
+                response.candidates[0].finish_reason if response.candidates else None
+            ),
+            latency=time.perf_counter() - start,
+        )
+
+    def _stream(self, prompt, model, images, max_tokens, config, on_chunk):
+        start = time.perf_counter()
+
+        def run():
+            text = ""
+            usage = None
+            finish_reason = None
+            for chunk in self.client.models.generate_content_stream(
+                model=model, contents=prompt, config=self._config(max_tokens, config)
+            ):
+                if chunk.text:
+                    text += chunk.text
+                    if on_chunk:
+                        on_chunk(text)
+                # Usage and finish reason arrive on the last chunk
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if chunk.candidates and chunk.candidates[0].finish_reason:
+                    finish_reason = chunk.candidates[0].finish_reason
+            return text, usage, finish_reason
+
+        text, usage, finish_reason = call_with_retries(run, self.is_retryable, self.max_retries)
+        return Completion(
+            text=text,
+            input_tokens=(usage.prompt_token_count or 0) if usage else 0,
+            output_tokens=(usage.candidates_token_count or 0) if usage else 0,
+            finish_reason=self._finish_reason(finish_reason),
+            latency=time.perf_counter() - start,
+        )
+
+
+class MockProvider(LLMProvider):
+    """Deterministic offline stand-in that returns plausible stories, YAML and code.
+
+    Latency is simulated as a fixed overhead plus a per-output-token cost, scaled
+    by MOCK_LATENCY_SCALE (0 disables sleeping).
+    """
+
+    # (overhead seconds, seconds per output token, seconds per input image)
+    LATENCY_PROFILES = {
+        "openai": (0.6, 0.012, 0.4),
+        "gemini": (0.3, 0.004, 0.2),
+    }
+    ENTITIES = ["user", "project", "task", "team", "comment", "invoice", "order", "product"]
+
+    def __init__(self, name="openai", latency_scale=MOCK_LATENCY_SCALE):
+        self.name = name
+        self.latency_scale = latency_scale
+        self.overhead, self.per_token, self.per_image = self.LATENCY_PROFILES.get(
+            name, self.LATENCY_PROFILES["openai"]
+        )
+
+    @staticmethod
+    def estimate_tokens(text):
+        return len(text) // 4 + 1
+
+    def _rng(self, text, images):
+        digest = hashlib.sha256(text.encode("utf-8"))
+        for image in images or ():
+            digest.update(image["data"])
+        return random.Random(digest.hexdigest())
+
+    def _entities(self, rng, text):
+        found = [entity for entity in self.ENTITIES if re.search(rf"\b{entity}s?\b", text, re.I)]
+        pool = found or self.ENTITIES
+        return sorted(rng.sample(pool, min(len(pool), rng.randint(2, 3))))
+
+    def _story(self, rng, text):
+        entity = rng.choice(self.ENTITIES)
+        action = rng.choice(["create", "edit", "search for", "delete", "review"])
+        return (
+            "#### **User Story:**\n"
+            f"As a registered user, I want to {action} a {entity} so that I can keep my work up to date.\n\n"
+            "#### **Acceptance Criteria:**\n"
+            f"- **Feature:** {action.capitalize()} {entity}\n"
+            f"  - **Scenario:** User can {action} a {entity} from the {entity} screen\n"
+            f"  - **Given:** The user is signed in and on the {entity} screen\n"
+            f"  - **When:** The user fills in the {entity} name field and clicks the Save button\n"
+            f"  - **Then:** The {entity} is saved and a confirmation message is displayed\n"
+        )
+
+    def _schema(self, rng, text):
+        lines = ["tables:"]
+        for entity in self._entities(rng, text):
+            lines += [
+                f"  {entity}s:",
+                "    columns:",
+                "      - id:",
+                "          type: Integer",
+                "          primary_key: true",
+                "      - name:",
+                "          type: String(100)",
+            ]
+            if entity != "user":
+                lines += [
+                    "      - user_id:",
+                    "          type: Integer",
+                    "          foreign_key: users.id",
+                ]
+        if "  users:" not in lines:
+            lines += [
+                "  users:",
+                "    columns:",
+                "      - id:",
+                "          type: Integer",
+                "          primary_key: true",
+            ]
+        return "```yaml\n" + "\n".join(lines) + "\n```"
+
+    def _code(self, rng, text):
+        lines = [
+            "from flask import Flask, jsonify, request",
+            "from flask_cors import CORS",
+            "",
+            "app = Flask(__name__)",
+            "CORS(app)",
+            "",
+        ]
+        for entity in self._entities(rng, text):
+            lines += [
+                f"@app.route('/{entity}s', methods=['GET'])",
+                f"def list_{entity}s():",
+                "    return jsonify([])",
+                "",
+                f"@app.route('/{entity}s', methods=['POST'])",
+                f"def create_{entity}():",
+                "    payload = request.get_json() or {}",
+                "    return jsonify(payload), 201",
+                "",
+            ]
+        lines += ["if __name__ == '__main__':", "    app.run()"]
+        return "```python\n" + "\n".join(lines) + "\n```"
+
+    def _patch(self, rng, text):
+        entity = rng.choice(self.ENTITIES)
+        action = rng.choice(["archive", "export", "share", "restore"])
+        return "\n".join(
+            [
+                "<<<<<<< SEARCH",
+                "=======",
+                f"@app.route('/{entity}s/<int:item_id>/{action}', methods=['POST'])",
+                f"def {action}_{entity}_{rng.randrange(10000)}(item_id):",
+                "    return jsonify({'id': item_id}), 200",
+                ">>>>>>> REPLACE",
+            ]
+        )
+
+    def _respond(self, text, images):
+        rng = self._rng(text, images)
+        lowered = text.lower()
+        if images and len(images) > 1 and "### image k" in lowered:
+            # Batched screenshots: one section per image, in order
+            return "\n\n".join(
+                f"### Image {k}\n" + self._story(self._rng(text, [image]), text)
+                for k, image in enumerate(images, 1)
+            )
+        if images or "user stories with acceptance criteria" in lowered:
+            return self._story(rng, text)
+        if "schema code generation" in lowered:
+            return self._schema(rng, text)
+        if "search/replace blocks" in lowered:
+            return self._patch(rng, text)
+        return self._code(rng, text)
+
+    def _generate(self, prompt, images, max_tokens):
+        text = prompt if isinstance(prompt, str) else "\n".join(prompt)
+        output = self._respond(text, images)
+        output_tokens = self.estimate_tokens(output)
+
+        finish_reason = "STOP"
+        if max_tokens and output_tokens > max_tokens:
+            output = output[: max_tokens * 4]
+            output_tokens = max_tokens
+            finish_reason = "MAX_TOKENS"
+
+        return Completion(
+            text=output,
+            # Vision requests are billed roughly 765 tokens per high-detail image
+            input_tokens=self.estimate_tokens(text) + 765 * len(images or ()),
+            output_tokens=output_tokens,
+            finish_reason=finish_reason,
+            upload_bytes=images_upload_bytes(images),
+        )
+
+    def _sleep(self, seconds):
+        if self.latency_scale > 0:
+            time.sleep(seconds * self.latency_scale)
+
+    def _complete(self, prompt, model, images, max_tokens, config):
+        start = time.perf_counter()
+        completion = self._generate(prompt, images, max_tokens)
+        self._sleep(
+            self.overhead
+            + self.per_token * completion.output_tokens
+            + self.per_image * len(images or ())
+        )
+        completion.latency = time.perf_counter() - start
+        return completion
+
+    def _stream(self, prompt, model, images, max_tokens, config, on_chunk):
+        start = time.perf_counter()
+        completion = self._generate(prompt, images, max_tokens)
+
+        # Time to first token, then the text arrives in chunks
+        self._sleep(self.overhead + self.per_image * len(images or ()))
+        text = completion.text
+        chunk_size = 200
+        for end in range(chunk_size, len(text) + chunk_size, chunk_size):
+            self._sleep(self.per_token * (chunk_size // 4))
+            if on_chunk:
+                on_chunk(text[:end])
+        completion.latency = time.perf_counter() - start
+        return completion
+
+
+class FixtureMissingError(KeyError):
+    """Raised in replay mode when no recorded response matches a request."""
+
+
+def normalize_prompt(prompt):
+    """Joins list prompts and collapses whitespace so formatting-only changes keep the same key."""
+    text = prompt if isinstance(prompt, str) else "\n".join(prompt)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def fixture_key(provider, prompt, model, images=None, max_tokens=None, config=None):
+    """Hash of everything that determines a model response."""
+    digest = hashlib.sha256()
+    for part in (
+        provider,
+        model,
+        normalize_prompt(prompt),
+        str(max_tokens),
+        json.dumps(config or {}, sort_keys=True),
+    ):
+        digest.update(part.encode("utf-8") + b"\0")
+    for image in images or ():
+        digest.update(hashlib.sha256(image["data"]).digest())
+    return digest.hexdigest()
+
+
+class ReplayProvider(LLMProvider):
+    """Records responses of an inner provider to JSON fixtures, or replays them with original timing."""
+
+    def __init__(self, name, inner_factory, mode="replay", directory=None, latency_scale=None):
+        self.name = name
+        self.mode = mode
+        self.directory = directory or LLM_FIXTURES_DIR
+        self.latency_scale = REPLAY_LATENCY_SCALE if latency_scale is None else latency_scale
+        self._inner_factory = inner_factory
+        self._inner = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def inner(self):
+        # Replay-only runs never build a live client (and need no API keys)
+        with self._lock:
+            if self._inner is None:
+                self._inner = self._inner_factory()
+            return self._inner
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{self.name}-{key}.json")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, key, completion, chunks):
+        fixture = {
+            "provider": self.name,
+            "text": completion.text,
+            "input_tokens": completion.input_tokens,
+            "output_tokens": completion.output_tokens,
+            "finish_reason": completion.finish_reason,
+            "latency": completion.latency,
+            "upload_bytes": completion.upload_bytes,
+            "chunks": chunks,  # [seconds since start, characters so far]
+        }
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(fixture, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def _replay(self, fixture, on_chunk):
+        start = time.perf_counter()
+        text = fixture["text"]
+        chunks = fixture.get("chunks") or [[fixture["latency"], len(text)]]
+        for offset, length in chunks:
+            delay = offset * self.latency_scale - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            if on_chunk:
+                on_chunk(text[:length])
+        remaining = fixture["latency"] * self.latency_scale - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        return Completion(
+            text=text,
+            input_tokens=fixture["input_tokens"],
+            output_tokens=fixture["output_tokens"],
+            finish_reason=fixture["finish_reason"],
+            latency=time.perf_counter() - start,
+            upload_bytes=fixture["upload_bytes"],
+        )
+
+    def _run(self, prompt, model, images, max_tokens, config, on_chunk, streaming):
+        key = fixture_key(self.name, prompt, model, images, max_tokens, config)
+        if self.mode in ("replay", "auto"):
+            fixture = self._load(key)
+            if fixture is not None:
+                return self._replay(fixture, on_chunk if streaming else None)
+            if self.mode == "replay":
+                raise FixtureMissingError(f"No recorded {self.name} response for key {key}")
+
+        chunks = []
+        start = time.perf_counter()
+
+        def record_chunk(text):
+            chunks.append([round(time.perf_counter() - start, 4), len(text)])
+            if on_chunk:
+                on_chunk(text)
+
+        if streaming:
+            completion = self.inner._stream(prompt, model, images, max_tokens, config, record_chunk)
+        else:
+            completion = self.inner._complete(prompt, model, images, max_tokens, config)
+        self._save(key, completion, chunks)
+        return completion
+
+    def _complete(self, prompt, model, images, max_tokens, config):
+        return self._run(prompt, model, images, max_tokens, config, None, False)
+
+    def _stream(self, prompt, model, images, max_tokens, config, on_chunk):
+        return self._run(prompt, model, images, max_tokens, config, on_chunk, True)
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def create_provider(name, record_mode=None):
+    """Builds a new provider for name, honouring LLM_BACKEND and LLM_RECORD_MODE."""
+    record_mode = record_mode or LLM_RECORD_MODE
+    if record_mode != "off":
+        return ReplayProvider(name, lambda: create_provider(name, "off"), record_mode)
+    if LLM_BACKEND == "mock":
+        return MockProvider(name)
+    settings = PROVIDER_SETTINGS[name]
+    if name == "openai":
+        return OpenAIProvider(timeout=settings["timeout"], max_retries=settings["max_retries"])
+    if name == "gemini":
+        return GeminiProvider(timeout=settings["timeout"], max_retries=settings["max_retries"])
+    raise ValueError(f"Unknown provider: {name}")
+
+
+def get_provider(name):
+    """Returns the process-wide provider for name, creating its pooled client on first use."""
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = create_provider(name)
+        return _providers[name]
+
+
+def set_record_mode(mode, directory=None):
+    """Switches record/replay mode for this process (e.g. from tests) and drops cached providers."""
+    global LLM_RECORD_MODE, LLM_FIXTURES_DIR
+    with _providers_lock:
+        LLM_RECORD_MODE = mode
+        if directory:
+            LLM_FIXTURES_DIR = directory
+        _providers.clear()
@@ -0,0 +1,205 @@
+"""Startup benchmark: import time, cold start and rerun latency of the Streamlit app.
+
+Examples:
+    python startup_benchmark.py --output startup.json
+    python startup_benchmark.py --repeats 10 --baseline startup.json
+
+Each repeat starts a fresh Python process (against the mock LLM backend), so
+every measurement is a cold start:
+
+- import: wall time of ``import app``, with the slowest direct imports from
+  ``python -X importtime``;
+- cold start: the first script run of the app page (nothing uploaded yet),
+  through Streamlit's AppTest;
+- rerun: further runs of the same session, as after a widget change.
+
+It also lists which heavy SDKs (openai, google.genai, fitz, PIL) were loaded
+before anything was uploaded; none should be. With --baseline, the exit status
+is non-zero when a timing regresses beyond --tolerance or an SDK starts loading
+at startup again.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmark import percentile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ["openai", "google.genai", "fitz", "PIL"]
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+print(json.dumps({{
+    "import_s": time.perf_counter() - start,
+    "heavy_modules": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+APP_TEST_SCRIPT = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+
+at = AppTest.from_file({script!r}, default_timeout={timeout!r})
+start = time.perf_counter()
+at.run()
+first_run_s = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+reruns = []
+for _ in range({reruns!r}):
+    start = time.perf_counter()
+    at.run()
+    reruns.append(time.perf_counter() - start)
+print(json.dumps({{
+    "first_run_s": first_run_s,
+    "rerun_s": reruns,
+    "heavy_modules": heavy,
+    "exceptions": [exception.message for exception in at.exception],
+}}))
+"""
+
+
+def run_python(code, env, importtime=False):
+    """Runs code in a fresh interpreter in the app directory. Returns (last stdout line as JSON, stderr)."""
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"benchmark process failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log, limit=10):
+    """Returns the slowest modules imported directly by app, from ``-X importtime`` output."""
+    rows = []
+    for line in importtime_log.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        # app itself is at depth 0 (one space); its direct imports at depth 1
+        if match and len(match.group(3)) == 3:
+            rows.append({"module": match.group(4), "cumulative_ms": int(match.group(2)) / 1000})
+    rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return rows[:limit]
+
+
+def compare(results, baseline, tolerance):
+    """Returns human-readable regressions of results against a baseline result file."""
+    regressions = []
+
+    def check(label, current, previous):
+        if previous and current > previous * (1 + tolerance):
+            regressions.append(f"{label}: {previous} -> {current}")
+
+    check("import.p50_s", results["import"]["p50_s"], baseline["import"]["p50_s"])
+    for section in ("cold_start", "rerun"):
+        if section in results and section in baseline:
+            check(f"{section}.p50_s", results[section]["p50_s"], baseline[section]["p50_s"])
+    for section in ("import", "cold_start"):
+        for name in results.get(section, {}).get("heavy_modules", []):
+            if name not in baseline.get(section, {}).get("heavy_modules", []):
+                regressions.append(f"{section}: {name} is loaded before anything is uploaded")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh processes per measurement")
+    parser.add_argument("--reruns", type=int, default=5, help="Reruns per cold-started session")
+    parser.add_argument(
+        "--skip-app-test", action="store_true", help="Only measure imports, not script runs"
+    )
+    parser.add_argument("--timeout", type=float, default=60, help="AppTest timeout per run in seconds")
+    parser.add_argument("--output", help="Write JSON results here (default: stdout)")
+    parser.add_argument("--baseline", help="Previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="startup-bench-")
+    env = dict(
+        os.environ,
+        LLM_BACKEND="mock",
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        JOBS_DIR=os.path.join(workdir, "jobs"),
+        TRACE_FILE="",
+    )
+
+    import_times = []
+    heavy = set()
+    importtime_log = ""
+    for _ in range(args.repeats):
+        measured, importtime_log = run_python(
+            IMPORT_SCRIPT.format(heavy=HEAVY_MODULES), env, importtime=True
+        )
+        import_times.append(measured["import_s"])
+        heavy.update(measured["heavy_modules"])
+    results = {
+        "import": {
+            "p50_s": round(statistics.median(import_times), 4),
+            "max_s": round(max(import_times), 4),
+            "heavy_modules": sorted(heavy),
+            "slowest": slowest_imports(importtime_log),
+        }
+    }
+
+    if not args.skip_app_test:
+        first_runs = []
+        reruns = []
+        heavy = set()
+        for _ in range(args.repeats):
+            measured, _ = run_python(
+                APP_TEST_SCRIPT.format(
+                    script=os.path.join(ROOT, "app.py"),
+                    timeout=args.timeout,
+                    heavy=HEAVY_MODULES,
+                    reruns=args.reruns,
+                ),
+                env,
+            )
+            if measured["exceptions"]:
+                raise RuntimeError(f"app raised during startup: {measured['exceptions'][0]}")
+            first_runs.append(measured["first_run_s"])
+            reruns += measured["rerun_s"]
+            heavy.update(measured["heavy_modules"])
+        results["cold_start"] = {
+            "p50_s": round(statistics.median(first_runs), 4),
+            "max_s": round(max(first_runs), 4),
+            "heavy_modules": sorted(heavy),
+        }
+        results["rerun"] = {
+            "p50_s": round(percentile(reruns, 0.5), 4),
+            "p95_s": round(percentile(reruns, 0.95), 4),
+            "count": len(reruns),
+        }
+    results["config"] = {
+        key: value for key, value in vars(args).items() if key not in ("output", "baseline")
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
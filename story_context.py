@@ -0,0 +1,95 @@
+import os
+import re
+
+# Token budget for the "previous stories" section of schema and code prompts
+STORY_CONTEXT_TOKENS = int(os.getenv("STORY_CONTEXT_TOKENS", "2000"))
+# Share of the budget spent on full text of the most relevant earlier stories
+RELEVANT_SHARE = 0.6
+
+WORD_RE = re.compile(r"[a-zA-Z][a-zA-Z0-9_]{3,}")
+STOP_WORDS = {
+    "user", "story", "want", "that", "then", "when", "given", "with", "should",
+    "scenario", "feature", "acceptance", "criteria", "have", "this", "will", "from",
+}
+
+
+def estimate_tokens(text):
+    """Rough token estimate (about 4 characters per token) used for budgeting."""
+    return len(text) // 4 + 1
+
+
+def story_terms(story):
+    """Returns the set of significant lower-case words in a story."""
+    return {
+        word.lower()
+        for word in WORD_RE.findall(story)
+        if word.lower() not in STOP_WORDS
+    }
+
+
+def summarize_story(story, max_chars=300):
+    """Returns a one-paragraph summary: the 'As a ...' statement and feature names."""
+    lines = [line.strip(" #*-\t") for line in story.splitlines()]
+    keep = [
+        line
+        for line in lines
+        if line.lower().startswith("as a") or line.lower().startswith("feature")
+    ]
+    summary = " ".join(keep) if keep else " ".join(line for line in lines if line)
+    summary = re.sub(r"\*+", "", summary)
+    if len(summary) > max_chars:
+        summary = summary[: max_chars - 3].rstrip() + "..."
+    return summary
+
+
+def build_story_context(previous_stories, current_story, token_budget=STORY_CONTEXT_TOKENS):
+    """Builds a token-bounded context of earlier stories for the current step.
+
+    The earlier stories that share the most terms with the current one are kept in
+    full, up to RELEVANT_SHARE of the budget; every other story is reduced to a
+    one-line summary, newest first, until the budget is spent.
+    """
+    if not previous_stories:
+        return ""
+
+    current_terms = story_terms(current_story)
+    scored = []
+    for index, story in enumerate(previous_stories):
+        terms = story_terms(story)
+        union = current_terms | terms
+        score = len(current_terms & terms) / len(union) if union else 0.0
+        scored.append((score, index))
+    scored.sort(key=lambda item: (-item[0], -item[1]))
+
+    remaining = token_budget
+    full = set()
+    for score, index in scored:
+        cost = estimate_tokens(previous_stories[index])
+        if score <= 0 or cost > remaining - token_budget * (1 - RELEVANT_SHARE):
+            continue
+        full.add(index)
+        remaining -= cost
+
+    summaries = {}
+    omitted = 0
+    for index in range(len(previous_stories) - 1, -1, -1):
+        if index in full:
+            continue
+        summary = summarize_story(previous_stories[index])
+        cost = estimate_tokens(summary)
+        if cost > remaining:
+            omitted += 1
+            continue
+        summaries[index] = summary
+        remaining -= cost
+
+    # Keep the original story order in the prompt
+    parts = []
+    if omitted:
+        parts.append(f"({omitted} earlier stories omitted for length)")
+    for index in range(len(previous_stories)):
+        if index in full:
+            parts.append(f"Story {index + 1}:\n{previous_stories[index]}")
+        elif index in summaries:
+            parts.append(f"Story {index + 1} (summary): {summaries[index]}")
+    return "\n\n".join(parts)
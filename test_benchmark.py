@@ -0,0 +1,18 @@
+import pytest
+
+from benchmark import percentile
+
+
+@pytest.mark.parametrize(
+    "values, fraction, expected",
+    [
+        (list(range(1, 11)), 0.5, 5),
+        (list(range(1, 21)), 0.95, 19),
+        (list(range(1, 11)), 0.95, 10),
+        (list(range(1, 11)), 0.0, 1),
+        ([3], 0.5, 3),
+        ([], 0.5, 0.0),
+    ],
+)
+def test_nearest_rank_percentile(values, fraction, expected):
+    assert percentile(values, fraction) == expected
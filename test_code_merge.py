@@ -0,0 +1,60 @@
+from code_merge import merge_story_modules, split_imports
+
+BOILERPLATE = """from flask import (
+    Flask,
+    jsonify,
+)
+
+app = Flask(__name__)
+
+
+@app.route("/a")
+def a():
+    return jsonify({"a": 1})
+
+
+if __name__ == "__main__":
+    app.run()
+"""
+
+
+def test_multi_line_imports_are_hoisted_whole():
+    module = "from models import (\n    User,\n)\n\n\n@app.route('/users')\ndef users():\n    return jsonify([])\n"
+    merged = merge_story_modules(BOILERPLATE, [module])
+    compile(merged, "<merged>", "exec")
+    assert merged.index("    User,") < merged.index("app = Flask")
+
+
+def test_duplicate_multi_line_import_is_merged_once():
+    module = "from flask import (\n    Flask,\n    jsonify,\n)\n\n\ndef ping():\n    return 'pong'\n"
+    merged = merge_story_modules(BOILERPLATE, [module])
+    assert merged.count("from flask import") == 1
+    compile(merged, "<merged>", "exec")
+
+
+def test_backslash_continued_import():
+    imports, body = split_imports("from os.path import join, \\\n    exists\nx = 1")
+    assert imports == ["from os.path import join, \\\n    exists"]
+    assert body == ["x = 1"]
+
+
+def test_identical_definition_is_dropped():
+    module = '@app.route("/a")\ndef a():\n    return jsonify({"a": 1})\n'
+    merged = merge_story_modules(BOILERPLATE, [module])
+    assert merged.count("def a(") == 1
+
+
+def test_colliding_definition_is_renamed_not_dropped():
+    module = '@app.route("/a2")\ndef a():\n    return jsonify({"a": a.__name__})\n'
+    merged = merge_story_modules(BOILERPLATE, [module])
+    compile(merged, "<merged>", "exec")
+    assert '@app.route("/a2")\ndef a_story1():' in merged
+    assert "a_story1.__name__" in merged
+    assert '{"a": a_story1' in merged  # The string key is left alone
+
+
+def test_story_code_goes_before_entry_point_in_story_order():
+    modules = ["def first():\n    pass\n", "", "def third():\n    pass\n"]
+    merged = merge_story_modules(BOILERPLATE, modules)
+    assert merged.index("def first") < merged.index("def third") < merged.index("__main__")
+    assert "User story 3" in merged and "User story 2" not in merged
@@ -0,0 +1,38 @@
+import pytest
+
+from validation import ValidationError, validate_schema
+
+SCHEMA = """tables:
+  users:
+    columns:
+      - id:
+          type: Integer
+          primary_key: true
+  tasks:
+    columns:
+      - id:
+          type: Integer
+          primary_key: true
+      - owner:
+          type: Integer
+          foreign_key: {foreign_key}
+"""
+
+
+@pytest.mark.parametrize(
+    "foreign_key",
+    ["users.id", "users(id)", "users (id)", "{table: users, column: id}", "{references: users.id}", "users"],
+)
+def test_common_foreign_key_notations_are_accepted(foreign_key):
+    _, schema = validate_schema(SCHEMA.format(foreign_key=foreign_key))
+    assert schema.tables["tasks"].column("owner").foreign_key.startswith("users")
+
+
+@pytest.mark.parametrize(
+    "foreign_key, problem",
+    [("ghosts.id", "missing table ghosts"), ("users(nope)", "missing column users.nope")],
+)
+def test_dangling_foreign_keys_are_reported(foreign_key, problem):
+    with pytest.raises(ValidationError) as error:
+        validate_schema(SCHEMA.format(foreign_key=foreign_key))
+    assert problem in str(error.value)
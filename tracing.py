@@ -0,0 +1,149 @@
+"""Lightweight span tracing with an OpenTelemetry-shaped JSONL exporter.
+
+Spans nest through a context variable, so work submitted to a thread pool via
+``contextvars.copy_context().run`` keeps its parent. Finished spans are kept in
+memory for the most recent MAX_TRACES traces, for the Streamlit sidebar panel.
+When TRACE_FILE is set they are also appended there (one JSON object per line,
+using OTLP field names); the file is rotated to ``<TRACE_FILE>.1`` once it
+exceeds TRACE_FILE_MAX_MB.
+"""
+
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+
+# Off by default; e.g. TRACE_FILE=traces/spans.jsonl enables the file exporter
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_FILE_MAX_MB = float(os.getenv("TRACE_FILE_MAX_MB", "50"))
+# Finished spans kept in memory per trace for the UI, for this many recent traces
+MAX_SPANS_PER_TRACE = int(os.getenv("MAX_SPANS_PER_TRACE", "5000"))
+MAX_TRACES = int(os.getenv("MAX_TRACES", "200"))
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_export_lock = threading.Lock()
+_recent_spans = OrderedDict()  # trace ID -> spans, least recently active first
+
+
+def new_trace_id():
+    return secrets.token_hex(16)
+
+
+class Span:
+    """A timed operation. Set attributes with span.set(key=value)."""
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.status = "OK"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id or "",
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": self.status},
+        }
+
+
+def _export(span):
+    with _export_lock:
+        if span.trace_id not in _recent_spans:
+            _recent_spans[span.trace_id] = deque(maxlen=MAX_SPANS_PER_TRACE)
+        _recent_spans.move_to_end(span.trace_id)
+        _recent_spans[span.trace_id].append(span)
+        while len(_recent_spans) > MAX_TRACES:
+            _recent_spans.popitem(last=False)
+        if not TRACE_FILE:
+            return
+        try:
+            directory = os.path.dirname(TRACE_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            max_bytes = TRACE_FILE_MAX_MB * 1024 * 1024
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > max_bytes:
+                os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+        except OSError as e:
+            print(f"Could not write trace: {e}")
+
+
+@contextmanager
+def use_trace(trace_id):
+    """Makes trace_id the trace for spans started inside this block."""
+    token = _current_trace.set(trace_id)
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the enclosed block as a child of the current span."""
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else (_current_trace.get() or new_trace_id())
+    current = Span(name, trace_id, parent.span_id if parent else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "ERROR"
+        current.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_ns = time.time_ns()
+        _export(current)
+
+
+def recent_spans(trace_id):
+    """Finished spans of a trace still held in memory."""
+    with _export_lock:
+        return list(_recent_spans.get(trace_id, ()))
+
+
+def summarize_trace(trace_id):
+    """Returns one dict per span name (span, count, total_ms, mean_ms, input_tokens, output_tokens), slowest total first."""
+    totals = defaultdict(lambda: [0, 0.0, 0, 0])
+    for finished in recent_spans(trace_id):
+        entry = totals[finished.name]
+        entry[0] += 1
+        entry[1] += finished.duration_ms
+        entry[2] += finished.attributes.get("input_tokens", 0) or 0
+        entry[3] += finished.attributes.get("output_tokens", 0) or 0
+    rows = [
+        {
+            "span": name,
+            "count": count,
+            "total_ms": round(total_ms, 1),
+            "mean_ms": round(total_ms / count, 1),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+        for name, (count, total_ms, input_tokens, output_tokens) in totals.items()
+    ]
+    return sorted(rows, key=lambda row: -row["total_ms"])
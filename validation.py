@@ -0,0 +1,197 @@
+"""Fast local checks on model output before it is fed into the next call.
+
+A schema is parsed into typed dataclasses and its foreign keys and
+relationships are checked against the tables it defines; Python code is
+byte-compiled. Both raise ValidationError listing every problem found, so the
+failing step can be retried with that feedback.
+"""
+
+import re
+from dataclasses import dataclass, field
+
+import yaml
+
+from code_merge import strip_code_fences
+
+# users(id), users (id) or users.id
+FOREIGN_KEY_RE = re.compile(r"^\s*([\w$]+)\s*(?:\(\s*([\w$]+)\s*\)|\.([\w$]+))?\s*$")
+
+
+class ValidationError(ValueError):
+    """Raised when model output fails a local check. ``problems`` lists each issue."""
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super().__init__("; ".join(self.problems))
+
+
+@dataclass
+class Column:
+    name: str
+    type: str = ""
+    primary_key: bool = False
+    foreign_key: str = ""
+    unique: bool = False
+
+
+@dataclass
+class Relationship:
+    name: str
+    type: str = ""
+    related_table: str = ""
+    foreign_key: str = ""
+
+
+@dataclass
+class Table:
+    name: str
+    columns: list = field(default_factory=list)
+    relationships: list = field(default_factory=list)
+
+    def column(self, name):
+        return next((column for column in self.columns if column.name == name), None)
+
+
+@dataclass
+class Schema:
+    tables: dict = field(default_factory=dict)
+
+
+def _named_entries(value):
+    """Yields (name, attributes) from either a list of one-key mappings or a mapping."""
+    if isinstance(value, dict):
+        yield from value.items()
+    elif isinstance(value, list):
+        for entry in value:
+            if isinstance(entry, dict) and len(entry) == 1:
+                yield next(iter(entry.items()))
+            elif isinstance(entry, dict) and "name" in entry:
+                yield entry["name"], entry
+            else:
+                yield None, entry
+
+
+def normalize_foreign_key(value):
+    """Returns a column's foreign key as "table.column" (or "table"), from the notations models use.
+
+    Accepts ``users.id``, ``users(id)``, a mapping such as ``{table: users,
+    column: id}`` (``references``/``related_table`` also name the table) and a
+    bare table name. Anything else is returned as given so the check reports it.
+    """
+    if not value:
+        return ""
+    if isinstance(value, dict):
+        table = value.get("table") or value.get("references") or value.get("related_table") or ""
+        column = value.get("column") or value.get("field") or ""
+        if column:
+            return f"{table}.{column}"
+        value = table
+    match = FOREIGN_KEY_RE.match(str(value))
+    if not match:
+        return str(value)
+    table, column = match.group(1), match.group(2) or match.group(3)
+    return f"{table}.{column}" if column else table
+
+
+def parse_schema(text):
+    """Parses YAML schema text (fences allowed) into a Schema. Raises ValidationError."""
+    try:
+        data = yaml.safe_load(strip_code_fences(text or ""))
+    except yaml.YAMLError as e:
+        raise ValidationError([f"schema is not valid YAML: {e}"])
+    if not isinstance(data, dict) or not isinstance(data.get("tables"), dict):
+        raise ValidationError(["schema has no 'tables' mapping at the top level"])
+
+    problems = []
+    schema = Schema()
+    for table_name, table_data in data["tables"].items():
+        table = Table(str(table_name))
+        table_data = table_data if isinstance(table_data, dict) else {}
+        for name, attributes in _named_entries(table_data.get("columns")):
+            if name is None:
+                problems.append(f"table {table_name}: unreadable column entry {attributes!r}")
+                continue
+            attributes = attributes if isinstance(attributes, dict) else {"type": attributes}
+            table.columns.append(
+                Column(
+                    str(name),
+                    str(attributes.get("type", "")),
+                    bool(attributes.get("primary_key")),
+                    normalize_foreign_key(attributes.get("foreign_key")),
+                    bool(attributes.get("unique")),
+                )
+            )
+        for name, attributes in _named_entries(table_data.get("relationships")):
+            attributes = attributes if isinstance(attributes, dict) else {}
+            table.relationships.append(
+                Relationship(
+                    str(name),
+                    str(attributes.get("type", "")),
+                    str(attributes.get("related_table") or ""),
+                    str(attributes.get("foreign_key") or ""),
+                )
+            )
+        schema.tables[table.name] = table
+    if problems:
+        raise ValidationError(problems)
+    return schema
+
+
+def check_schema(schema):
+    """Returns the problems with a parsed schema's tables, foreign keys and relationships."""
+    problems = []
+    if not schema.tables:
+        problems.append("schema defines no tables")
+    for table in schema.tables.values():
+        if not table.columns:
+            problems.append(f"table {table.name} has no columns")
+        for column in table.columns:
+            if not column.foreign_key:
+                continue
+            target_table, _, target_column = column.foreign_key.partition(".")
+            target = schema.tables.get(target_table)
+            if target is None:
+                problems.append(
+                    f"{table.name}.{column.name} references missing table {target_table}"
+                )
+            elif target_column and target.column(target_column) is None:
+                problems.append(
+                    f"{table.name}.{column.name} references missing column {column.foreign_key}"
+                )
+        for relationship in table.relationships:
+            related = schema.tables.get(relationship.related_table)
+            if related is None:
+                problems.append(
+                    f"relationship {table.name}.{relationship.name} points to missing table "
+                    f"{relationship.related_table or '(none)'}"
+                )
+            elif relationship.foreign_key and not (
+                related.column(relationship.foreign_key) or table.column(relationship.foreign_key)
+            ):
+                problems.append(
+                    f"relationship {table.name}.{relationship.name} uses missing foreign key "
+                    f"column {relationship.foreign_key}"
+                )
+    return problems
+
+
+def validate_schema(text):
+    """Returns (clean_yaml, schema) for schema text, or raises ValidationError."""
+    clean = strip_code_fences(text or "").strip() + "\n"
+    schema = parse_schema(clean)
+    problems = check_schema(schema)
+    if problems:
+        raise ValidationError(problems)
+    return clean, schema
+
+
+def validate_python(code):
+    """Returns code without fences if it byte-compiles, else raises ValidationError."""
+    clean = strip_code_fences(code or "")
+    if not clean.strip():
+        raise ValidationError(["code is empty"])
+    try:
+        compile(clean, "<generated>", "exec")
+    except SyntaxError as e:
+        raise ValidationError([f"code does not compile: {e.msg} (line {e.lineno})"])
+    return clean